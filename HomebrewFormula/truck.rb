@@ -1,14 +1,27 @@
 class Truck < Formula
   desc "Truck - the simplest dependency manager"
-  url "https://github.com/Mazyod/homebrew-truck/archive/0.8.0.zip"
-  version "0.8.0"
+  url "https://github.com/Mazyod/homebrew-truck/archive/0.9.0.zip"
+  version "0.9.0"
   # sha256 "85cc828a96735bdafcf29eb6291ca91bac846579bcef7308536e0c875d6c81d7"
   depends_on "python3"
   depends_on "github-release" => :recommended
   depends_on "awscli" => :optional
 
   def install
-    bin.install "truck.py" => "truck"
+    # truck.py is imported by a launcher rather than run as a script, so
+    # that it's byte-compiled once here instead of on every run
+    python3 = Formula["python3"].opt_bin/"python3"
+    libexec.install "truck.py"
+    system python3, "-m", "compileall", "-q", libexec/"truck.py"
+    (bin/"truck").write <<~EOS
+      #!#{python3}
+      import sys
+      sys.path.insert(0, "#{libexec}")
+      import truck
+      sys.argv[0] = "truck"
+      truck.main()
+    EOS
+    chmod 0755, bin/"truck"
   end
 
   test do
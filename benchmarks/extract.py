@@ -0,0 +1,82 @@
+#!/usr/local/bin/python3
+"""
+Compares ZipExtractor against ZipFile.extractall on a synthetic archive.
+
+usage: python3 benchmarks/extract.py [--files 4000] [--size 65536] [--jobs N]
+"""
+import os
+import time
+import shutil
+import zipfile
+import argparse
+import tempfile
+import importlib.util
+
+
+def load_truck():
+    path = os.path.join(os.path.dirname(__file__), os.pardir, "truck.py")
+    spec = importlib.util.spec_from_file_location("truck", path)
+    truck = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(truck)
+    return truck
+
+
+def make_archive(path, files, size):
+    # half random (incompressible) and half repetitive payloads, spread
+    # across a framework-like directory layout
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zref:
+        for i in range(files):
+            payload = os.urandom(size) if i % 2 else (b"#define TRUCK %d\n" % i) * (size // 16)
+            zref.writestr(f"Bench.framework/Headers/{i % 32}/file{i}.h", payload)
+
+
+def measure(label, archive_path, extract):
+    root = tempfile.mkdtemp()
+    try:
+        start = time.perf_counter()
+        extract(root)
+        duration = time.perf_counter() - start
+    finally:
+        shutil.rmtree(root)
+
+    with zipfile.ZipFile(archive_path) as zref:
+        infos = zref.infolist()
+    total = sum(i.file_size for i in infos)
+    print(f"{label:>16}: {duration:6.2f}s, {total / duration / 2 ** 20:8.1f} MB/s, "
+          f"{len(infos) / duration:8.0f} files/s")
+    return duration
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=4000)
+    parser.add_argument("--size", type=int, default=64 * 1024)
+    parser.add_argument("--jobs", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    truck = load_truck()
+    workdir = tempfile.mkdtemp()
+    archive_path = os.path.join(workdir, "bench.zip")
+    make_archive(archive_path, args.files, args.size)
+
+    def extractall(root):
+        with zipfile.ZipFile(archive_path) as zref:
+            zref.extractall(root)
+
+    def parallel(jobs):
+        def extract(root):
+            with zipfile.ZipFile(archive_path) as zref:
+                truck.ZipExtractor(archive_path, jobs).extract(zref.infolist(), root)
+        return extract
+
+    try:
+        baseline = measure("extractall", archive_path, extractall)
+        for jobs in sorted(set([1, 2, 4, args.jobs])):
+            duration = measure(f"{jobs} jobs", archive_path, parallel(jobs))
+            print(f"{'':>16}  {baseline / duration:.2f}x extractall")
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+#!/usr/local/bin/python3
+"""
+Checks that deps sharing a top level directory keep each other's files
+through sync and pull, against the local GitHub stand-in of suite.py.
+
+usage: python3 benchmarks/shared_dirs.py
+"""
+import os
+import json
+import shutil
+import tempfile
+import threading
+
+from suite import GithubStandIn, run_truck, USER, REPO
+
+VERSION = "1.0.0"
+TARGETS = {"SharedA": "a.txt", "SharedB": "b.txt"}
+
+
+def main():
+    workdir = tempfile.mkdtemp()
+    home = os.path.join(workdir, "home")
+    client = os.path.join(workdir, "client")
+    storage = os.path.join(workdir, "storage")
+    for path in (home, client, storage):
+        os.makedirs(path)
+
+    server = GithubStandIn(storage, 0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    download_url = f"{server.url}/{USER}/{REPO}/releases/download/truck"
+    env = dict(os.environ, HOME=home)
+
+    def write_truckrc(tree_store):
+        with open(os.path.join(home, ".truckrc"), "w") as f:
+            f.write(json.dumps({"GITHUB_TOKEN": "check", "TREE_STORE": tree_store}))
+
+    def check_files(action):
+        # every dep's file must have survived the others being installed
+        for name, filename in TARGETS.items():
+            path = os.path.join(client, "Truck", "Shared", filename)
+            if not os.path.isfile(path):
+                raise SystemExit(f"{action}: {name}'s Shared/{filename} is missing")
+            with open(path) as f:
+                if f.read() != name:
+                    raise SystemExit(f"{action}: {name}'s Shared/{filename} has the wrong content")
+
+    try:
+        write_truckrc("")
+        for name, filename in TARGETS.items():
+            author = os.path.join(workdir, name)
+            os.makedirs(os.path.join(author, "Shared"))
+            with open(os.path.join(author, "Shared", filename), "w") as f:
+                f.write(name)
+            with open(os.path.join(author, "truck-author.json"), "w") as f:
+                f.write(json.dumps({"github": {
+                    "user": USER, "repo": REPO, "api_url": f"{server.url}/api", "download_url": download_url
+                }}))
+            with open(os.path.join(author, f"{name}-config.json"), "w") as f:
+                f.write(json.dumps({"files": ["Shared"]}))
+            run_truck(["release", name, VERSION], author, env)
+
+        with open(os.path.join(client, "truck.json"), "w") as f:
+            f.write(json.dumps([{"url": f"{download_url}/{name}.json", "version": VERSION} for name in TARGETS]))
+
+        for tree_store in ("", "symlink", "hardlink"):
+            write_truckrc(tree_store)
+            shutil.rmtree(os.path.join(client, "Truck"), ignore_errors=True)
+            for action in ("sync", "pull"):
+                run_truck([action], client, env)
+                check_files(f"{action} (TREE_STORE={tree_store!r})")
+            print(f"TREE_STORE={tree_store!r}: ok")
+    finally:
+        server.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+#!/usr/local/bin/python3
+"""
+Measures truck's startup cost for the commands run on every build. truck.py
+is imported by a launcher, like the formula installs it, so it's measured
+byte-compiled rather than compiled on every run.
+
+usage: python3 benchmarks/startup.py [--runs 20] [--project DIR] [--budget-ms N]
+"""
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import statistics
+import subprocess
+import time
+
+COMMANDS = ["version", "check", "list"]
+TRUCK_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir, "truck.py"))
+LAUNCHER = "import sys, truck; sys.argv[0] = 'truck'; truck.main()"
+
+
+def make_project():
+    # an empty, in-sync project, so that no command touches the network
+    path = tempfile.mkdtemp()
+    with open(os.path.join(path, "truck.json"), "w") as f:
+        f.write(json.dumps([]))
+    os.makedirs(os.path.join(path, "Truck"))
+    return path
+
+
+def run(command, project, extra=()):
+    return subprocess.run(
+        [sys.executable, *extra, "-c", LAUNCHER, command],
+        cwd=project,
+        env=dict(os.environ, PYTHONPATH=os.path.dirname(TRUCK_PATH)),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True
+    )
+
+
+def measure(command, project, runs):
+    # a command failing early would look fast
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = run(command, project)
+        timings.append((time.perf_counter() - start) * 1000)
+        if result.returncode:
+            print(result.stderr)
+            raise SystemExit(f"truck {command} failed with {result.returncode}")
+    return timings
+
+
+def slowest_imports(command, project, count):
+    # top level entries of the "-X importtime" report, nested ones are
+    # indented further and already included in their parent's cumulative time
+    report = run(command, project, ("-X", "importtime")).stderr
+    imports = []
+    for line in report.splitlines():
+        fields = line[len("import time:"):].split("|")
+        if not line.startswith("import time:") or not fields[1].strip().isdigit():
+            continue
+        if fields[2].startswith("  "):
+            continue
+        imports.append((int(fields[1]), fields[2].strip()))
+    return sorted(imports, reverse=True)[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--project", help="project directory to run in, defaults to an empty one")
+    parser.add_argument("--budget-ms", type=float, help="fail if any median exceeds this")
+    parser.add_argument("--imports", type=int, default=8, help="number of slowest imports to show")
+    args = parser.parse_args()
+
+    project = args.project or make_project()
+    # writes truck.py's bytecode, as installing it does
+    subprocess.run([sys.executable, "-m", "compileall", "-q", TRUCK_PATH], check=True)
+    try:
+        timings = []
+        for _ in range(args.runs):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, "-c", "pass"])
+            timings.append((time.perf_counter() - start) * 1000)
+        print(f"{'python':>8}: median {statistics.median(timings):7.1f}ms (interpreter baseline)")
+
+        over_budget = []
+        for command in COMMANDS:
+            timings = measure(command, project, args.runs)
+            median = statistics.median(timings)
+            print(f"{command:>8}: median {median:7.1f}ms, min {min(timings):7.1f}ms, "
+                  f"max {max(timings):7.1f}ms")
+            for cumulative, name in slowest_imports(command, project, args.imports):
+                print(f"{'':>10}{cumulative / 1000:7.1f}ms {name}")
+            if args.budget_ms and median > args.budget_ms:
+                over_budget.append(command)
+    finally:
+        if not args.project:
+            shutil.rmtree(project)
+
+    if over_budget:
+        print(f"Over the {args.budget_ms}ms budget: {', '.join(over_budget)}")
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
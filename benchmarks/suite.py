@@ -0,0 +1,312 @@
+#!/usr/local/bin/python3
+"""
+End-to-end benchmarks of release, sync, pull and check, against a local
+stand-in for GitHub releases.
+
+usage: python3 benchmarks/suite.py [--files 200] [--size 262144] [--compressibility 0.5]
+                                   [--runs 5] [--jobs N] [--latency 0]
+                                   [--json results.json] [--baseline previous.json]
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import shutil
+import hashlib
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+TRUCK_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir, "truck.py"))
+TARGET = "Bench"
+VERSION = "1.0.0"
+USER = "user"
+REPO = "repo"
+
+
+class GithubHandler(BaseHTTPRequestHandler):
+    # release assets are served behind a redirect to "storage", like github
+    # does, with ETag and Range support. The api only covers the endpoints
+    # truck's release uploads go through
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, code, body=b"", headers=None):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode()
+        self.send_response(code)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def release(self):
+        return {
+            "id": 1,
+            "tag_name": "truck",
+            "upload_url": f"{self.server.url}/uploads/repos/{USER}/{REPO}/releases/1/assets{{?name,label}}"
+        }
+
+    def serve_asset(self, name):
+        path = os.path.join(self.server.root, name)
+        if not os.path.isfile(path):
+            return self.reply(404, {"message": "Not Found"})
+
+        size = os.path.getsize(path)
+        etag = '"%s"' % hashlib.md5(f"{name}{size}{os.path.getmtime(path)}".encode()).hexdigest()
+        if self.headers.get("If-None-Match") == etag:
+            return self.reply(304, headers={"ETag": etag})
+
+        start = 0
+        match = re.match(r"bytes=(\d+)-$", self.headers.get("Range", ""))
+        if match and int(match.group(1)) < size:
+            start = int(match.group(1))
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{size - 1}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(size - start))
+        self.end_headers()
+
+        with open(path, "rb") as f:
+            f.seek(start)
+            shutil.copyfileobj(f, self.wfile)
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        path = self.path.split("?")[0]
+        download_prefix = f"/{USER}/{REPO}/releases/download/truck/"
+
+        if path.startswith(download_prefix):
+            name = path[len(download_prefix):]
+            signature = hashlib.sha256(f"{name}{time.time()}".encode()).hexdigest()
+            return self.reply(302, headers={"Location": f"{self.server.url}/storage/{name}?sig={signature}"})
+        if path.startswith("/storage/"):
+            return self.serve_asset(path[len("/storage/"):])
+        if path == f"/api/repos/{USER}/{REPO}/releases/tags/truck":
+            return self.reply(200, self.release())
+        if path == f"/api/repos/{USER}/{REPO}/releases/1/assets":
+            with self.server.lock:
+                return self.reply(200, list(self.server.assets.values()))
+        self.reply(404, {"message": "Not Found"})
+
+    def do_POST(self):
+        time.sleep(self.server.latency)
+        size = int(self.headers.get("Content-Length", 0))
+        match = re.match(rf"/uploads/repos/{USER}/{REPO}/releases/1/assets\?name=(.+)", self.path)
+        if not match:
+            self.rfile.read(size)
+            return self.reply(201 if self.path.endswith("/releases") else 404, self.release())
+
+        name = match.group(1)
+        with open(os.path.join(self.server.root, name), "wb") as f:
+            while size > 0:
+                block = self.rfile.read(min(size, 1024 * 1024))
+                f.write(block)
+                size -= len(block)
+
+        with self.server.lock:
+            self.server.next_id += 1
+            asset = {"id": self.server.next_id, "name": name}
+            self.server.assets[name] = asset
+        self.reply(201, asset)
+
+    def do_DELETE(self):
+        time.sleep(self.server.latency)
+        with self.server.lock:
+            for name, asset in list(self.server.assets.items()):
+                if self.path.endswith(f"/releases/assets/{asset['id']}"):
+                    del self.server.assets[name]
+                    os.remove(os.path.join(self.server.root, name))
+                    return self.reply(204)
+        self.reply(404, {"message": "Not Found"})
+
+
+class GithubStandIn(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, root, latency):
+        super().__init__(("127.0.0.1", 0), GithubHandler)
+        self.root = root
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.assets = {}
+        self.next_id = 0
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_port}"
+
+
+def make_target(path, files, size, compressibility, seed=0):
+    # a framework-like tree of files, each made of a compressible text
+    # part and an incompressible random part
+    rng = random.Random(seed)
+    compressible_size = int(size * compressibility)
+    for i in range(files):
+        directory = os.path.join(path, f"{TARGET}.framework", "Headers" if i % 4 else "Modules", str(i % 16))
+        os.makedirs(directory, exist_ok=True)
+        text = (b"#define BENCH_%d %d\n" % (i, rng.randrange(1 << 30))) * (compressible_size // 24 + 1)
+        with open(os.path.join(directory, f"file{i}.h"), "wb") as f:
+            f.write(text[:compressible_size] + rng.randbytes(size - compressible_size))
+
+
+def run_truck(args, cwd, env):
+    # wall time and peak rss of a single truck invocation
+    with tempfile.TemporaryFile() as output:
+        start = time.perf_counter()
+        process = subprocess.Popen(
+            [sys.executable, TRUCK_PATH, *args], cwd=cwd, env=env, stdout=output, stderr=subprocess.STDOUT
+        )
+        _, status, usage = os.wait4(process.pid, 0)
+        duration = time.perf_counter() - start
+        process.returncode = os.waitstatus_to_exitcode(status)
+
+        if process.returncode:
+            output.seek(0)
+            print(output.read().decode(errors="replace"))
+            raise SystemExit(f"truck {' '.join(args)} failed with {process.returncode}")
+
+    # ru_maxrss is in bytes on macOS, in kilobytes elsewhere
+    rss = usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+    return duration, rss
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, round(p / 100 * (len(values) - 1)))]
+
+
+def summarize(durations, rss, payload_size):
+    p50 = percentile(durations, 50)
+    return {
+        "durations": durations,
+        "p50": p50,
+        "p90": percentile(durations, 90),
+        "p99": percentile(durations, 99),
+        "mean": sum(durations) / len(durations),
+        "throughput": payload_size / p50 if payload_size else None,
+        "peak_rss": max(rss)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=200)
+    parser.add_argument("--size", type=int, default=256 * 1024, help="size of every file, in bytes")
+    parser.add_argument("--compressibility", type=float, default=0.5, help="compressible share of every file")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--jobs", type=int, help="passed to truck as --jobs")
+    parser.add_argument("--latency", type=float, default=0, help="seconds added to every request")
+    parser.add_argument("--json", help="writes the results to this file")
+    parser.add_argument("--baseline", help="results of an earlier run to compare against")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    home = os.path.join(workdir, "home")
+    author = os.path.join(workdir, "author")
+    client = os.path.join(workdir, "client")
+    storage = os.path.join(workdir, "storage")
+    for path in (home, author, client, storage):
+        os.makedirs(path)
+
+    server = GithubStandIn(storage, args.latency)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    download_url = f"{server.url}/{USER}/{REPO}/releases/download/truck"
+
+    env = dict(os.environ, HOME=home)
+    jobs = ["--jobs", str(args.jobs)] if args.jobs else []
+    with open(os.path.join(home, ".truckrc"), "w") as f:
+        f.write(json.dumps({"GITHUB_TOKEN": "bench"}))
+    with open(os.path.join(author, "truck-author.json"), "w") as f:
+        f.write(json.dumps({"github": {
+            "user": USER, "repo": REPO, "api_url": f"{server.url}/api", "download_url": download_url
+        }}))
+    with open(os.path.join(author, f"{TARGET}-config.json"), "w") as f:
+        f.write(json.dumps({"files": [f"{TARGET}.framework"]}))
+    with open(os.path.join(client, "truck.json"), "w") as f:
+        f.write(json.dumps([{"url": f"{download_url}/{TARGET}.json", "version": VERSION}]))
+
+    try:
+        make_target(author, args.files, args.size, args.compressibility)
+        run_truck(["release", TARGET, VERSION, *jobs], author, env)
+        archive_size = os.path.getsize(os.path.join(storage, f"{TARGET}-{VERSION}.zip"))
+
+        def nuke_cache():
+            shutil.rmtree(os.path.join(home, "Library"), ignore_errors=True)
+            shutil.rmtree(os.path.join(client, "Truck"), ignore_errors=True)
+
+        def remove_deps():
+            shutil.rmtree(os.path.join(client, "Truck"), ignore_errors=True)
+
+        # (name, truck arguments, directory, setup before every run, payload size)
+        scenarios = [
+            ("release", ["release", TARGET, VERSION, *jobs], author, None, archive_size),
+            ("sync (cold cache)", ["sync", *jobs], client, nuke_cache, archive_size),
+            ("sync (warm cache)", ["sync", *jobs], client, remove_deps, archive_size),
+            ("pull (warm cache)", ["pull", *jobs], client, None, archive_size),
+            ("check", ["check"], client, None, None)
+        ]
+
+        total_size = args.files * args.size
+        print(f"{args.files} files, {total_size / 2 ** 20:.1f} MB, "
+              f"{args.compressibility:.0%} compressible -> {archive_size / 2 ** 20:.1f} MB archive")
+        print(f"{'scenario':<20} {'p50':>9} {'p90':>9} {'p99':>9} {'MB/s':>8} {'peak rss':>9}")
+
+        results = {}
+        for name, truck_args, cwd, setup, payload_size in scenarios:
+            durations, rss = [], []
+            for _ in range(args.runs):
+                if setup:
+                    setup()
+                duration, peak = run_truck(truck_args, cwd, env)
+                durations.append(duration)
+                rss.append(peak)
+
+            result = results[name] = summarize(durations, rss, payload_size)
+            throughput = f"{result['throughput'] / 2 ** 20:8.1f}" if payload_size else f"{'-':>8}"
+            print(f"{name:<20} {result['p50'] * 1000:7.0f}ms {result['p90'] * 1000:7.0f}ms "
+                  f"{result['p99'] * 1000:7.0f}ms {throughput} {result['peak_rss'] / 2 ** 20:7.1f}MB")
+    finally:
+        server.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "params": {k: v for k, v in vars(args).items() if k not in ("json", "baseline")},
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count()
+        },
+        "archive_size": archive_size,
+        "results": results
+    }
+    if args.json:
+        with open(args.json, "w") as f:
+            f.write(json.dumps(report, indent=2) + "\n")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.loads(f.read())
+        if baseline["params"] != report["params"]:
+            print("warning: the baseline was run with different parameters")
+        print(f"{'scenario':<20} {'baseline p50':>13} {'p50':>9} {'change':>8}")
+        for name, result in results.items():
+            previous = baseline["results"].get(name)
+            if not previous:
+                continue
+            change = (result["p50"] - previous["p50"]) / previous["p50"]
+            print(f"{name:<20} {previous['p50'] * 1000:11.0f}ms {result['p50'] * 1000:7.0f}ms {change:+8.1%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,32 +3,50 @@
 Truck - a straight-forward dependency/binary manager
 this file contains both the client and authoring tools.
 """
+import io
 import sys
 import os
 import re
 import json
+import stat
+import zlib
 import time
-import zipfile
 import shutil
-import urllib
+import fcntl
 import hashlib
-from collections import OrderedDict
-from urllib.request import FancyURLopener, urlopen
-from distutils.version import LooseVersion
+import threading
+from functools import cached_property
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager
+
+# networking, archiving and distutils modules are imported where they're
+# used, so that quick commands (version, check, list) don't pay for them.
+# See benchmarks/startup.py
 
 
 ####
 # Global configuration / constants
 #
 
-TRUCK_VERSION = "0.8.0"
+TRUCK_VERSION = "0.9.0"
 
 TRUCK_ROOT_DIRECTORY = "Truck"
 TRUCK_TMP_DIRECTORY = os.path.join(TRUCK_ROOT_DIRECTORY, "Tmp")
+TRUCK_STATE_FILEPATH = os.path.join(TRUCK_ROOT_DIRECTORY, ".state")
+TRUCK_MANIFESTS_DIRECTORY = os.path.join(TRUCK_ROOT_DIRECTORY, ".manifests")
+TRUCK_TRASH_DIRECTORY = os.path.join(TRUCK_ROOT_DIRECTORY, ".trash")
+TRUCK_CONFIG_FILENAME = "truck.json"
+TRUCK_LOCK_FILENAME = "truck.lock"
+TRUCK_SECRETS_FILEPATH = os.path.expanduser("~/.truckrc")
 
 TRUCK_SECRETS_TEMPLATE = {
     "SWIFT_VERSION_OVERRIDE": "",
-    "GITHUB_TOKEN": ""
+    "GITHUB_TOKEN": "",
+    "CACHE_SIZE_LIMIT": "",
+    "CACHE_CHUNKS": False,
+    "SPEC_TTL": "",
+    "MIRROR": "",
+    "TREE_STORE": ""
 }
 
 TRUCK_AUTHOR_TEMPLATE = {
@@ -38,15 +56,106 @@ TRUCK_AUTHOR_TEMPLATE = {
     }
 }
 
+GITHUB_API_URL = "https://api.github.com"
+GITHUB_RELEASE_TAG = "truck"
+
 TRUCK_SPEC_FILENAME = "{target}-spec.json"
+# published next to the specs, combining all of them
+TRUCK_INDEX_FILENAME = "index.json"
 TARGET_CONFIG_FILEPATH = "{target}-config.json"
 
+ARCHIVE_FORMATS = ("zip", "tar.gz", "tar.zst")
+# compression methods for each archive format, the first being the default
+COMPRESSION_METHODS = {
+    "zip": ("deflate", "stored", "bzip2", "lzma"),
+    "tar.gz": ("gzip",),
+    "tar.zst": ("zstd",)
+}
+# valid levels, methods missing here always use their default level
+COMPRESSION_LEVELS = {
+    "deflate": range(0, 10),
+    "bzip2": range(1, 10),
+    "gzip": range(0, 10),
+    "zstd": range(1, 23)
+}
+# settings compared by bench-pack, as (format, compression, level)
+BENCH_PACK_SETTINGS = [
+    ("zip", "stored", None),
+    ("zip", "deflate", 1),
+    ("zip", "deflate", 6),
+    ("zip", "deflate", 9),
+    ("zip", "bzip2", 9),
+    ("zip", "lzma", None),
+    ("tar.gz", "gzip", 6),
+    ("tar.zst", "zstd", 3),
+    ("tar.zst", "zstd", 19)
+]
+
+DEFAULT_SYNC_JOBS = 4
+# deltas over this share of the full archive aren't published
+DELTA_MAX_RATIO = 0.8
+DOWNLOAD_BLOCK_SIZE = 1024 * 1024
+DOWNLOAD_TIMEOUT = 60
+DOWNLOAD_RETRIES = 5
+DOWNLOAD_BACKOFF = 1
+DEFAULT_SPEC_TTL = 5 * 60
+HTTP_POOL_SIZE = 8
+# a source slower than this share of the fastest alternative's measured
+# throughput is given up on (keeping what it sent) after the grace period
+MIRROR_SLOW_RATIO = 0.25
+MIRROR_GRACE_PERIOD = 5
+# how long the losers of a spec race get to wind down once cancelled
+SPEC_RACE_GRACE_PERIOD = 1
+# smaller downloads are dominated by latency, and say little about throughput
+THROUGHPUT_MIN_SIZE = 1024 * 1024
+MIRROR_PORT = 8744
+# the hosts truck serve fetches archives from, unless given --allow
+MIRROR_ALLOWED_HOSTS = "github.com"
+# how deps are installed from the extracted tree store, see TreeStore
+TREE_LINK_MODES = ("symlink", "hardlink", "clone")
+# how long a checkout's new symlinks to a tree count before being swapped in
+TREE_REF_GRACE_PERIOD = 60 * 60
+
 
 ####
 # Basic Entities
 #
 
+class DownloadError(Exception):
+    pass
+
+
+class SlowDownload(DownloadError):
+    def __init__(self, message, rate):
+        super().__init__(message)
+        self.rate = rate
+
+
+class IntegrityError(DownloadError):
+    pass
+
+
+class DownloadCancelled(DownloadError):
+    pass
+
+
 class DownloadCache:
+    # entries are keyed by the sha256 of their content when it is known
+    # upfront (release archives), falling back to the md5 of their url.
+    # index.json tracks the size and last access of every entry, so the
+    # cache can be kept under CACHE_SIZE_LIMIT by evicting the LRU entries.
+    # With CACHE_CHUNKS enabled, zip archives are stored as recipes of
+    # chunks instead, so versions sharing most of their content share most
+    # of their disk space too. index.json then refcounts every chunk, which
+    # is deleted as soon as no recipe references it
+
+    INDEX_LOCK = threading.Lock()
+    # zip members this big get chunks of their own, split every
+    # MAX_CHUNK_SIZE, while smaller ones are grouped by their crc
+    MIN_CHUNK_SIZE = 64 * 1024
+    MAX_CHUNK_SIZE = 4 * 1024 * 1024
+    GROUP_DIVISOR = 8
+
     def __init__(self):
         self.cache_dir = os.path.expanduser("~/Library/Caches/truck")
 
@@ -56,87 +165,1671 @@ class DownloadCache:
         os.makedirs(path, exist_ok=True)
         return path
 
+    @property
+    def chunks_dir(self):
+        path = os.path.join(self.cache_dir, "chunks")
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    @property
+    def recipes_dir(self):
+        path = os.path.join(self.cache_dir, "recipes")
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    @property
+    def chunked(self):
+        return bool(Truck.secrets().get("CACHE_CHUNKS"))
+
+    def chunk_path(self, digest):
+        return os.path.join(self.chunks_dir, digest[:2], digest)
+
+    def recipe_path(self, key):
+        return os.path.join(self.recipes_dir, key + ".json")
+
     def key_for_url(self, url):
         hashfun = hashlib.md5()
         hashfun.update(url.encode())
         return hashfun.hexdigest()
 
-    def cache_path_for_url(self, url):
-        key = self.key_for_url(url)
+    def cache_path_for_url(self, url, sha256=None):
+        key = sha256 or self.key_for_url(url)
         return os.path.join(self.downloads_dir, key)
 
-    def nuke(self):
+    @property
+    def index_path(self):
+        return os.path.join(self.cache_dir, "index.json")
+
+    @property
+    def size_limit(self):
+        return parse_size(Truck.secrets().get("CACHE_SIZE_LIMIT"))
+
+    @property
+    def spec_ttl(self):
+        ttl = Truck.secrets().get("SPEC_TTL")
+        return DEFAULT_SPEC_TTL if ttl in (None, "") else float(ttl)
+
+    def load_index(self):
         try:
-            shutil.rmtree(self.downloads_dir)
+            with open(self.index_path) as f:
+                index = json.loads(f.read())
         except:
-            pass
+            index = {}
+
+        index.setdefault("entries", {})
+        # chunk digest -> [size, number of recipes referencing it]
+        index.setdefault("chunks", {})
+        index.setdefault("hits", 0)
+        index.setdefault("misses", 0)
+        # host -> measured download throughput, in bytes per second
+        index.setdefault("hosts", {})
+        return index
+
+    @contextmanager
+    def edit_index(self):
+        # other trucks (e.g. syncing other checkouts) edit the index too, so
+        # the whole read-modify-write holds an exclusive lock on index.lock,
+        # lest their updates (and chunk references) get lost
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with DownloadCache.INDEX_LOCK, open(self.index_path + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            index = self.load_index()
+            yield index
+            # write to a temp file first, so readers never see partial json
+            tmp_path = f"{self.index_path}.{os.getpid()}"
+            with open(tmp_path, "w+") as f:
+                f.write(json.dumps(index))
+            os.replace(tmp_path, self.index_path)
+
+    def reconcile_index(self, index):
+        # picks up entries cached before the index existed, and drops the
+        # ones which were removed behind our back
+        entries = index["entries"]
+        keys = set(os.listdir(self.downloads_dir))
+        recipe_keys = set(os.path.splitext(name)[0] for name in os.listdir(self.recipes_dir))
+        for key in set(entries) - keys - recipe_keys:
+            if entries[key].get("chunked"):
+                self.remove_entry(index, key)
+            else:
+                del entries[key]
+
+        for key in keys - set(entries):
+            stat = os.stat(os.path.join(self.downloads_dir, key))
+            entries[key] = {"url": None, "size": stat.st_size, "atime": stat.st_mtime}
+
+    def disk_size(self, index):
+        # chunked entries only take the space of the chunks they reference
+        blobs = sum(e["size"] for e in index["entries"].values() if not e.get("chunked"))
+        return blobs + sum(size for size, _ in index["chunks"].values())
+
+    def remove_entry(self, index, key):
+        # removes an entry from disk and index, returning the space freed
+        entry = index["entries"].pop(key)
+        if not entry.get("chunked"):
+            try:
+                os.remove(os.path.join(self.downloads_dir, key))
+            except FileNotFoundError:
+                pass
+            return entry["size"]
 
-    def store(self, url, payload_path):
-        cache_path = self.cache_path_for_url(url)
         try:
-            shutil.copy2(payload_path, cache_path)
-            print(f"Cached {payload_path} -> {cache_path}")
+            with open(self.recipe_path(key)) as f:
+                recipe = json.loads(f.read())
+            os.remove(self.recipe_path(key))
+        except (FileNotFoundError, ValueError):
+            return 0
+
+        freed = 0
+        for digest in set(digest for digest, _ in recipe["chunks"]):
+            chunk = index["chunks"].get(digest)
+            if not chunk:
+                continue
+            chunk[1] -= 1
+            if chunk[1] <= 0:
+                del index["chunks"][digest]
+                freed += chunk[0]
+                try:
+                    os.remove(self.chunk_path(digest))
+                except FileNotFoundError:
+                    pass
+
+        return freed
+
+    def evict(self, index, limit, keep=None):
+        entries = index["entries"]
+        total_size = self.disk_size(index)
+        evicted = []
+
+        for key in sorted(entries, key=lambda k: entries[k]["atime"]):
+            if total_size <= limit:
+                break
+            if key == keep:
+                continue
+
+            entry = entries[key]
+            total_size -= self.remove_entry(index, key)
+            evicted.append(entry)
+
+        return evicted
+
+    def nuke(self):
+        for remove, path in [
+            (shutil.rmtree, self.downloads_dir),
+            (shutil.rmtree, self.chunks_dir),
+            (shutil.rmtree, self.recipes_dir),
+            (os.remove, self.index_path)
+        ]:
+            try:
+                remove(path)
+            except:
+                pass
+
+    def collect_chunks(self, index):
+        # recounts the references of every chunk from the recipes, deleting
+        # the chunks no recipe references (e.g. left over by interrupted runs)
+        chunks = {}
+        for key, entry in index["entries"].items():
+            if not entry.get("chunked"):
+                continue
+            with open(self.recipe_path(key)) as f:
+                recipe = json.loads(f.read())
+            for digest, size in dict(recipe["chunks"]).items():
+                chunks.setdefault(digest, [size, 0])[1] += 1
+        index["chunks"] = chunks
+
+        removed = 0
+        for prefix in os.listdir(self.chunks_dir):
+            for digest in os.listdir(os.path.join(self.chunks_dir, prefix)):
+                if digest not in chunks:
+                    os.remove(os.path.join(self.chunks_dir, prefix, digest))
+                    removed += 1
+
+        return removed
+
+    def gc(self):
+        limit = self.size_limit
+        with self.edit_index() as index:
+            self.reconcile_index(index)
+            evicted = self.evict(index, limit) if limit else []
+            removed_chunks = self.collect_chunks(index)
+
+        for entry in evicted:
+            print(f"Evicted {entry['url'] or 'unknown'} ({format_size(entry['size'])})")
+        print(f"Evicted {len(evicted)} entries")
+        print(f"Removed {removed_chunks} unreferenced chunks")
+        print(f"Removed {self.clean_tmp_dir()} stale partial downloads")
+
+    def stats(self, top=10):
+        with self.edit_index() as index:
+            self.reconcile_index(index)
+
+        entries = index["entries"]
+        lookups = index["hits"] + index["misses"]
+        hit_rate = 100 * index["hits"] / lookups if lookups else 0
+        limit = self.size_limit
+
+        print(f"Entries: {len(entries)}")
+        print(f"Total size: {format_size(sum(e['size'] for e in entries.values()))}")
+        chunked = [e for e in entries.values() if e.get("chunked")]
+        if chunked or index["chunks"]:
+            chunks_size = sum(size for size, _ in index["chunks"].values())
+            print(f"Chunked: {len(chunked)} archives ({format_size(sum(e['size'] for e in chunked))}) "
+                  f"in {len(index['chunks'])} chunks ({format_size(chunks_size)})")
+            print(f"Disk size: {format_size(self.disk_size(index))}")
+        print(f"Size limit: {format_size(limit) if limit else 'none'}")
+        print(f"Hit rate: {hit_rate:.1f}% ({index['hits']} hits, {index['misses']} misses)")
+
+        largest = sorted(entries.values(), key=lambda e: e["size"], reverse=True)
+        if largest:
+            print("Largest entries:")
+        for entry in largest[:top]:
+            print(f"{format_size(entry['size'])} {entry['url'] or 'unknown'}")
+
+    def record_lookup(self, url, cache_path, hit):
+        with self.edit_index() as index:
+            index["hits" if hit else "misses"] += 1
+            if hit:
+                entry = index["entries"].setdefault(os.path.basename(cache_path), {})
+                entry.update({"url": url, "atime": time.time()})
+                if not entry.get("chunked"):
+                    entry["size"] = os.path.getsize(cache_path)
+
+    @staticmethod
+    def host_for_url(url):
+        from urllib.parse import urlsplit
+        return urlsplit(url).netloc
+
+    def record_throughput(self, url, size, duration):
+        # exponentially weighted, so hosts getting faster or slower are
+        # ranked accordingly within a few downloads
+        if size < THROUGHPUT_MIN_SIZE:
+            return
+        sample = size / max(duration, 0.001)
+        with self.edit_index() as index:
+            previous = index["hosts"].get(self.host_for_url(url))
+            index["hosts"][self.host_for_url(url)] = sample if previous is None else 0.7 * previous + 0.3 * sample
+
+    def record_failure(self, url, rate=0):
+        # weighs more than a successful download, with the rate measured
+        # before giving up on a slow host, or nothing for a failing one
+        with self.edit_index() as index:
+            host = self.host_for_url(url)
+            previous = index["hosts"].get(host)
+            index["hosts"][host] = rate if previous is None else 0.5 * previous + 0.5 * rate
+
+    def rank_sources(self, urls):
+        # fastest first. Hosts never measured go first, in the given order,
+        # so that every mirror gets measured at least once
+        hosts = self.load_index()["hosts"]
+        return sorted(urls, key=lambda url: -hosts.get(self.host_for_url(url), float("inf")))
+
+    def min_rate(self, sources, source):
+        hosts = self.load_index()["hosts"]
+        rates = [hosts.get(self.host_for_url(s)) for s in sources if s != source]
+        best = max([rate for rate in rates if rate], default=None)
+        return best and best * MIRROR_SLOW_RATIO
+
+    def entry_for_url(self, url):
+        # the index entry for a cached url, including any validators stored
+        # along with it (ETag, Last-Modified)
+        key = self.key_for_url(url)
+        if not os.path.exists(os.path.join(self.downloads_dir, key)):
+            return None
+        return self.load_index()["entries"].get(key)
+
+    def mark_validated(self, url):
+        with self.edit_index() as index:
+            entry = index["entries"].get(self.key_for_url(url))
+            if entry:
+                entry["validated"] = time.time()
+
+    @property
+    def tmp_dir(self):
+        path = os.path.join(self.cache_dir, "tmp")
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def temp_path(self):
+        # downloads land next to the cache entries, so storing them is a
+        # rename rather than a copy
+        return os.path.join(self.tmp_dir, f"{os.getpid()}-{threading.get_ident()}-{time.time_ns()}")
+
+    @contextmanager
+    def partial_path(self, sha256=None):
+        # yields the path to download into, and whether it can be resumed.
+        # Partial downloads of known content are kept across runs, guarded
+        # by a lock in case another truck is downloading the same archive
+        if sha256:
+            path = os.path.join(self.tmp_dir, sha256 + ".part")
+            with open(path + ".lock", "w") as lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    locked = True
+                except OSError:
+                    locked = False
+
+                if locked:
+                    yield path, True
+                    return
+
+        yield self.temp_path(), False
+
+    def clean_tmp_dir(self, max_age=7 * 24 * 60 * 60):
+        # drops partial downloads which were never resumed
+        removed = 0
+        for name in os.listdir(self.tmp_dir):
+            path = os.path.join(self.tmp_dir, name)
+            if time.time() - os.path.getmtime(path) > max_age:
+                os.remove(path)
+                removed += 1
+
+        return removed
+
+    def chunk_ranges(self, path):
+        # contiguous (offset, size) ranges covering the archive. Rather than
+        # at fixed offsets, cuts are made around the data of big members,
+        # which lines up across versions whatever changed around it. Small
+        # members are cut after whenever their crc is a multiple of
+        # GROUP_DIVISOR, so a changed member only changes its own group
+        total_size = os.path.getsize(path)
+        cuts = set([total_size])
+        try:
+            data_ranges = ArchiveDelta.data_ranges(path)
+        except Exception:
+            data_ranges = []
+
+        for offset, size, crc in data_ranges:
+            if size >= self.MIN_CHUNK_SIZE:
+                cuts.update(range(offset, offset + size, self.MAX_CHUNK_SIZE))
+                cuts.add(offset + size)
+            elif crc % self.GROUP_DIVISOR == 0:
+                cuts.add(offset + size)
+
+        ranges = []
+        start = 0
+        for cut in sorted(cuts):
+            while cut - start > self.MAX_CHUNK_SIZE:
+                ranges.append((start, self.MAX_CHUNK_SIZE))
+                start += self.MAX_CHUNK_SIZE
+            if cut > start:
+                ranges.append((start, cut - start))
+                start = cut
+
+        return ranges
+
+    def write_chunk(self, f, digest, offset, size):
+        path = self.chunk_path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        f.seek(offset)
+        tmp_path = self.temp_path()
+        with open(tmp_path, "wb") as chunk:
+            chunk.write(f.read(size))
+        os.replace(tmp_path, path)
+
+    def store_chunked(self, url, payload_path, sha256, dst=None):
+        # splits the payload into chunks, writing the ones not stored yet,
+        # then records the recipe to reassemble it
+        size = os.path.getsize(payload_path)
+        chunks = []
+        written = 0
+        try:
+            with open(payload_path, "rb") as f:
+                for offset, chunk_size in self.chunk_ranges(payload_path):
+                    f.seek(offset)
+                    digest = hashlib.sha256(f.read(chunk_size)).hexdigest()
+                    chunks.append((digest, offset, chunk_size))
+                    if not os.path.exists(self.chunk_path(digest)):
+                        self.write_chunk(f, digest, offset, chunk_size)
+                        written += chunk_size
+
+            tmp_path = self.temp_path()
+            with open(tmp_path, "w") as f:
+                f.write(json.dumps({"url": url, "size": size, "chunks": [[d, s] for d, _, s in chunks]}))
+            os.replace(tmp_path, self.recipe_path(sha256))
+        except Exception as e:
+            print(e)
+            print(f"Chunking {payload_path} failed")
+            return False
+
+        limit = self.size_limit
+        with self.edit_index() as index, open(payload_path, "rb") as f:
+            self.reconcile_index(index)
+            entry = index["entries"].get(sha256)
+            if entry and not entry.get("chunked"):
+                self.remove_entry(index, sha256)
+            if not entry or not entry.get("chunked"):
+                for digest, offset, chunk_size in dict((c[0], c) for c in chunks).values():
+                    index["chunks"].setdefault(digest, [chunk_size, 0])[1] += 1
+                    # shared chunks may have been evicted by another thread
+                    # since, in which case they're written again
+                    if not os.path.exists(self.chunk_path(digest)):
+                        self.write_chunk(f, digest, offset, chunk_size)
+
+            index["entries"][sha256] = {"url": url, "size": size, "atime": time.time(), "chunked": True}
+            evicted = self.evict(index, limit, keep=sha256) if limit else []
+
+        print(f"Cached {url} -> {len(chunks)} chunks, {format_size(written)} new")
+        if evicted:
+            print(f"Evicted {len(evicted)} cache entries to stay under {format_size(limit)}")
+
+        if dst:
+            os.replace(payload_path, dst)
+        else:
+            os.remove(payload_path)
+        return True
+
+    def store(self, url, payload_path, sha256=None, meta=None, dst=None):
+        # moves the payload into the cache, then materializes it at dst (if
+        # given), returning whether it got cached
+        if sha256 and self.chunked and url.endswith(".zip"):
+            return self.store_chunked(url, payload_path, sha256, dst)
+
+        cache_path = self.cache_path_for_url(url, sha256)
+        try:
+            os.replace(payload_path, cache_path)
+            print(f"Cached {url} -> {cache_path}")
         except Exception as e:
             print(e)
             print(f"Caching {payload_path} -> {cache_path} failed")
+            return False
+
+        key = os.path.basename(cache_path)
+        limit = self.size_limit
+        with self.edit_index() as index:
+            self.reconcile_index(index)
+            if index["entries"].get(key, {}).get("chunked"):
+                self.remove_entry(index, key)
+            index["entries"][key] = {
+                "url": url,
+                "size": os.path.getsize(cache_path),
+                "atime": time.time(),
+                **(meta or {})
+            }
+            evicted = self.evict(index, limit, keep=key) if limit else []
+
+        if evicted:
+            print(f"Evicted {len(evicted)} cache entries to stay under {format_size(limit)}")
+
+        if dst:
+            materialize(cache_path, dst)
+        return True
+
+    def assemble(self, key, dst, size=None):
+        # rebuilds a chunked entry at dst, returning whether it could
+        try:
+            with open(self.recipe_path(key)) as f:
+                recipe = json.loads(f.read())
+        except (FileNotFoundError, ValueError):
+            return False
+
+        if size is not None and recipe["size"] != size:
+            print(f"Cache entry size mismatch {recipe['url']}")
+            return False
+
+        try:
+            with open(dst, "wb") as f:
+                for digest, _ in recipe["chunks"]:
+                    with open(self.chunk_path(digest), "rb") as chunk:
+                        shutil.copyfileobj(chunk, f)
+        except FileNotFoundError:
+            print(f"Cache entry is missing chunks {recipe['url']}")
+            os.remove(dst)
+            with self.edit_index() as index:
+                if key in index["entries"]:
+                    self.remove_entry(index, key)
+            return False
+
+        return True
+
+    def contains(self, url, sha256=None):
+        if os.path.exists(self.cache_path_for_url(url, sha256)):
+            return True
+        return bool(sha256) and os.path.exists(self.recipe_path(sha256))
+
+    @contextmanager
+    def cached_file(self, url, sha256=None):
+        # yields the path of a cached entry, reassembling chunked ones into a
+        # temporary file
+        cache_path = self.cache_path_for_url(url, sha256)
+        if os.path.exists(cache_path):
+            yield cache_path
+            return
+
+        path = self.temp_path()
+        try:
+            if not sha256 or not self.assemble(sha256, path):
+                raise DownloadError(f"{url} isn't cached")
+            yield path
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def fetch_to(self, url, dst, sha256=None, size=None):
+        cache_path = self.cache_path_for_url(url, sha256)
+        # content addressed entries were verified when stored, so checking
+        # the size is enough to weed out anything tampered with since
+        if size is not None and os.path.exists(cache_path):
+            if os.path.getsize(cache_path) != size:
+                print(f"Cache entry size mismatch {url}")
+                os.remove(cache_path)
 
-    def fetch_to(self, url, dst):
-        cache_path = self.cache_path_for_url(url)
         if os.path.exists(cache_path):
             print(f"Cache hit! {url}")
-            shutil.copy2(cache_path, dst)
+            materialize(cache_path, dst)
+            self.record_lookup(url, cache_path, True)
+            return True
+        elif sha256 and self.assemble(sha256, dst, size):
+            print(f"Cache hit! {url} (chunked)")
+            self.record_lookup(url, cache_path, True)
             return True
         else:
             print(f"Cache miss {url}")
+            self.record_lookup(url, cache_path, False)
             return False
 
-def reporthook(count, block_size, total_size):
-    global start_time
+def clone_file(src, dst):
+    # copy-on-write clone, sharing the blocks until either file is modified
+    if sys.platform == "darwin":
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        if libc.clonefile(os.fsencode(src), os.fsencode(dst), 0) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+    elif sys.platform.startswith("linux"):
+        FICLONE = 0x40049409
+        with open(src, "rb") as src_file, open(dst, "wb") as dst_file:
+            fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+    else:
+        raise OSError(f"cloning files isn't supported on {sys.platform}")
+
+def materialize(src, dst):
+    # places a copy of src at dst, avoiding copying the bytes whenever the
+    # filesystem allows it. Hardlinks are safe here since truck only ever
+    # reads the downloaded files before deleting them
+    for strategy in [clone_file, os.link, shutil.copy2]:
+        try:
+            os.remove(dst)
+        except FileNotFoundError:
+            pass
+
+        try:
+            strategy(src, dst)
+            return
+        except OSError:
+            if strategy is shutil.copy2:
+                raise
+
+def copy_tree(src, dst, strategy):
+    # recreates src (a file or directory) at dst, placing every file with
+    # strategy (os.link or clone_file), or copying it whenever the
+    # filesystem doesn't allow that. macOS clones whole directories at once
+    def place(src, dst):
+        try:
+            strategy(src, dst)
+        except OSError:
+            shutil.copy2(src, dst)
+
+    if strategy is clone_file and sys.platform == "darwin":
+        try:
+            clone_file(src, dst)
+            return
+        except OSError:
+            pass
+
+    if os.path.islink(src):
+        os.symlink(os.readlink(src), dst)
+    elif os.path.isdir(src):
+        shutil.copytree(src, dst, symlinks=True, copy_function=place)
+    else:
+        place(src, dst)
+
+
+class TreeStore:
+    # archives extracted once per machine, keyed by their sha256, for every
+    # checkout to share. Each tree holds the archive's files under files/,
+    # next to a manifest.json of their sizes and crcs. With TREE_STORE set
+    # to one of TREE_LINK_MODES, deps are installed by linking their top
+    # level files to the tree, so a version any checkout synced before costs
+    # neither a download nor an extraction. Trees are extracted into a
+    # temporary directory and renamed into place, so they're always complete.
+    # The manifest's mtime is bumped whenever a tree is linked, and trees no
+    # checkout symlinks to are evicted in LRU order to stay under
+    # CACHE_SIZE_LIMIT, a budget of their own on top of the download cache's.
+    # Checkouts symlinking to a tree are recorded under its refs/, and only
+    # count for as long as their links still point to it
+
+    MANIFEST_FILENAME = "manifest.json"
+    REFS_DIRNAME = "refs"
+
+    def __init__(self):
+        self.trees_dir = os.path.join(DownloadCache().cache_dir, "trees")
+
+    @property
+    def link_mode(self):
+        mode = Truck.secrets().get("TREE_STORE") or None
+        precondition(
+            mode in (None, *TREE_LINK_MODES), f"TREE_STORE should be one of {', '.join(TREE_LINK_MODES)}"
+        )
+        return mode
+
+    def tree_path(self, sha256):
+        return os.path.join(self.trees_dir, sha256)
+
+    def files_path(self, sha256):
+        return os.path.join(self.tree_path(sha256), "files")
+
+    def manifest_path(self, sha256):
+        return os.path.join(self.tree_path(sha256), self.MANIFEST_FILENAME)
+
+    def load(self, sha256):
+        # the manifest of a tree, or None if it isn't in the store
+        try:
+            with open(self.manifest_path(sha256)) as f:
+                return json.loads(f.read())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def add(self, sha256, url, extract):
+        # extract fills the given directory with the archive's files and
+        # returns their manifest. Checkouts syncing the same archive at once
+        # race to rename their tree into place, and the first one wins
+        import tempfile
+
+        os.makedirs(self.trees_dir, exist_ok=True)
+        tmp_path = tempfile.mkdtemp(prefix=sha256 + ".", suffix=".tmp", dir=self.trees_dir)
+        try:
+            files_path = os.path.join(tmp_path, "files")
+            files = extract(files_path)
+            with open(os.path.join(tmp_path, self.MANIFEST_FILENAME), "w+") as f:
+                f.write(json.dumps({
+                    "url": url,
+                    "size": sum(size for size, _ in files.values()),
+                    "top_level": sorted(os.listdir(files_path)),
+                    "files": files
+                }))
+
+            try:
+                os.rename(tmp_path, self.tree_path(sha256))
+                print(f"Stored tree {url} -> {self.tree_path(sha256)}")
+            except OSError:
+                if not self.load(sha256):
+                    raise
+        finally:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+        limit = DownloadCache().size_limit
+        evicted = self.evict(limit, keep=sha256) if limit else []
+        if evicted:
+            print(f"Evicted {len(evicted)} trees to stay under {format_size(limit)}")
+        return self.load(sha256)
+
+    def link(self, sha256, names, root, mode, checkout):
+        # links names into root, which checkout then renames into place
+        os.utime(self.manifest_path(sha256))
+        if mode == "symlink":
+            self.add_ref(sha256, checkout)
+
+        files_path = self.files_path(sha256)
+        for name in names:
+            src, dst = os.path.join(files_path, name), os.path.join(root, name)
+            if os.path.lexists(dst):
+                PathUtils.remove(dst)
+            if mode == "symlink":
+                os.symlink(src, dst)
+            else:
+                copy_tree(src, dst, os.link if mode == "hardlink" else clone_file)
+
+    def trees(self):
+        try:
+            names = os.listdir(self.trees_dir)
+        except FileNotFoundError:
+            return []
+        return [name for name in names if not name.endswith(".tmp")]
+
+    def ref_path(self, sha256, checkout):
+        key = hashlib.md5(os.path.abspath(checkout).encode()).hexdigest()
+        return os.path.join(self.tree_path(sha256), self.REFS_DIRNAME, key)
+
+    def add_ref(self, sha256, checkout):
+        path = self.ref_path(sha256, checkout)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w+") as f:
+            f.write(os.path.abspath(checkout))
+
+    def refs(self, sha256):
+        # the checkouts still symlinking to the tree, forgetting the ones
+        # which were deleted or moved on to other versions. Refs are added
+        # while the links are staged, so recent ones count regardless
+        refs_path = os.path.join(self.tree_path(sha256), self.REFS_DIRNAME)
+        try:
+            names = os.listdir(refs_path)
+        except FileNotFoundError:
+            return []
+
+        files_path = self.files_path(sha256)
+        top_level = (self.load(sha256) or {}).get("top_level", [])
+        checkouts = []
+        for name in names:
+            path = os.path.join(refs_path, name)
+            try:
+                with open(path) as f:
+                    checkout = f.read()
+                recent = time.time() - os.path.getmtime(path) < TREE_REF_GRACE_PERIOD
+            except FileNotFoundError:
+                continue
+
+            links = [os.path.join(checkout, top) for top in top_level]
+            if recent or any(os.path.islink(link) and os.path.dirname(os.readlink(link)) == files_path
+                             for link in links):
+                checkouts.append(checkout)
+            else:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+        return checkouts
+
+    def evict(self, limit, keep=None):
+        # removes the least recently linked trees no checkout symlinks to,
+        # until the store fits in limit, returning their manifests. Trees are
+        # renamed away before being deleted, so they disappear at once
+        trees = []
+        for sha256 in self.trees():
+            manifest = self.load(sha256)
+            if manifest:
+                trees.append((os.path.getmtime(self.manifest_path(sha256)), sha256, manifest))
+
+        total = sum(manifest["size"] for _, _, manifest in trees)
+        evicted = []
+        for _, sha256, manifest in sorted(trees):
+            if total <= limit:
+                break
+            if sha256 == keep or self.refs(sha256):
+                continue
+
+            evicted_path = f"{self.tree_path(sha256)}.{os.getpid()}.tmp"
+            try:
+                os.rename(self.tree_path(sha256), evicted_path)
+            except FileNotFoundError:
+                continue
+            shutil.rmtree(evicted_path, ignore_errors=True)
+            total -= manifest["size"]
+            evicted.append(manifest)
+
+        return evicted
+
+    def stats(self):
+        manifests = [m for m in map(self.load, self.trees()) if m]
+        symlinked = len([sha256 for sha256 in self.trees() if self.refs(sha256)])
+        print(f"Trees: {len(manifests)} ({format_size(sum(m['size'] for m in manifests))}), "
+              f"{symlinked} symlinked by a checkout")
+
+    def gc(self, max_age=24 * 60 * 60):
+        # trees some checkout still symlinks to are never evicted, but the
+        # others are, along with the leftovers of interrupted extractions
+        limit = DownloadCache().size_limit
+        for manifest in self.evict(limit) if limit else []:
+            print(f"Evicted tree {manifest['url']} ({format_size(manifest['size'])})")
+
+        removed = 0
+        for name in os.listdir(self.trees_dir) if os.path.isdir(self.trees_dir) else []:
+            path = os.path.join(self.trees_dir, name)
+            if name.endswith(".tmp") and time.time() - os.path.getmtime(path) > max_age:
+                shutil.rmtree(path, ignore_errors=True)
+                removed += 1
+        print(f"Removed {removed} interrupted tree extractions")
 
-    if count == 0:
-        start_time = time.time()
+    def nuke(self):
+        shutil.rmtree(self.trees_dir, ignore_errors=True)
+
+def parse_size(value):
+    # accepts byte counts, or human friendly sizes like "500M" and "20G"
+    if not value:
+        return None
+
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+    value = str(value).strip().upper().rstrip("B")
+    multiplier = units.get(value[-1:], 1)
+    if value[-1:] in units:
+        value = value[:-1]
+
+    precondition(value.replace(".", "", 1).isdigit(), f"Invalid size: {value}")
+    return int(float(value) * multiplier)
+
+def format_size(size):
+    for unit in ["B", "KB", "MB", "GB"]:
+        if size < 1024:
+            return f"{size:.1f} {unit}" if unit != "B" else f"{size} B"
+        size /= 1024
+    return f"{size:.1f} TB"
+
+def reporthook(progress_size, total_size, start_time):
+    # progress lines are useless when piped or buffered by a worker thread
+    if not sys.stdout.isatty():
         return
 
-    duration = time.time() - start_time
-    progress_size = int(count * block_size)
+    duration = max(time.time() - start_time, 0.001)
     speed = int(progress_size / (1024 * duration))
-    percent = int(count * block_size * 100 / total_size)
+    percent = int(progress_size * 100 / total_size) if total_size > 0 else 0
 
     sys.stdout.write('\x1b[2K\r')
     sys.stdout.write("... %d%%, %d MB, %d KB/s, %d seconds passed" %
                     (percent, progress_size / (1024 * 1024), speed, duration))
     sys.stdout.flush()
 
-def download(url, filename, check_cache=True):
-    cache = DownloadCache()
-    hit = check_cache and cache.fetch_to(url, filename)
-    if hit:
-        return
+class PooledResponse:
+    # wraps an http.client response, handing the connection back to the
+    # pool once the body has been consumed
+
+    def __init__(self, transport, origin, connection, response):
+        self.transport = transport
+        self.origin = origin
+        self.connection = connection
+        self.response = response
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response.headers
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def read(self, amt=None):
+        return self.response.read(amt)
+
+    def readinto(self, buffer):
+        return self.response.readinto(buffer)
+
+    def readinto1(self, buffer):
+        return self.response.readinto1(buffer)
+
+    def drain(self):
+        body = self.read()
+        self.close()
+        return body
+
+    def close(self):
+        if not self.connection:
+            return
+
+        if self.response.isclosed() and not self.response.will_close:
+            self.transport.checkin(self.origin, self.connection)
+        else:
+            self.response.close()
+            self.connection.close()
+        self.connection = None
+
+
+class HttpTransport:
+    # shared by every download, keeping persistent connections per host so
+    # consecutive requests to github (and the storage it redirects to) skip
+    # the TCP and TLS handshakes. Redirects are remembered too, permanently
+    # for 301/308, and briefly for the signed urls github redirects to
+
+    SHARED = None
+    REDIRECT_CODES = (301, 302, 303, 307, 308)
+    PERMANENT_REDIRECT_CODES = (301, 308)
+    MAX_REDIRECTS = 10
+    REDIRECT_TTL = 60
+
+    @classmethod
+    def shared(cls):
+        if not cls.SHARED:
+            cls.SHARED = cls()
+        return cls.SHARED
+
+    def __init__(self, pool_size=HTTP_POOL_SIZE, timeout=DOWNLOAD_TIMEOUT):
+        import ssl
+        from urllib.request import getproxies
+
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.redirects = {}
+        self.proxies = getproxies()
+        self.ssl_context = ssl.create_default_context()
+
+    def connect(self, scheme, host, port):
+        import http.client
+        from urllib.parse import urlsplit
+        from urllib.request import proxy_bypass
+
+        proxy = self.proxies.get(scheme)
+        if proxy and proxy_bypass(host):
+            proxy = None
+
+        if not proxy:
+            if scheme == "https":
+                return http.client.HTTPSConnection(
+                    host, port, timeout=self.timeout, context=self.ssl_context,
+                    blocksize=DOWNLOAD_BLOCK_SIZE
+                )
+            return http.client.HTTPConnection(
+                host, port, timeout=self.timeout, blocksize=DOWNLOAD_BLOCK_SIZE
+            )
+
+        proxy = urlsplit(proxy if "://" in proxy else "http://" + proxy)
+        if scheme == "https":
+            connection = http.client.HTTPSConnection(
+                proxy.hostname, proxy.port or 80, timeout=self.timeout,
+                context=self.ssl_context, blocksize=DOWNLOAD_BLOCK_SIZE
+            )
+            connection.set_tunnel(host, port)
+            return connection
+        return http.client.HTTPConnection(
+            proxy.hostname, proxy.port or 80, timeout=self.timeout,
+            blocksize=DOWNLOAD_BLOCK_SIZE
+        )
+
+    def checkout(self, origin):
+        with self.lock:
+            connections = self.idle.get(origin)
+            if connections:
+                return connections.pop(), True
+
+        return self.connect(*origin), False
+
+    def checkin(self, origin, connection):
+        with self.lock:
+            connections = self.idle.setdefault(origin, [])
+            if len(connections) < self.pool_size:
+                connections.append(connection)
+                return
+
+        connection.close()
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, {}
+
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+    def resolve(self, url):
+        with self.lock:
+            for _ in range(self.MAX_REDIRECTS):
+                location, expiry = self.redirects.get(url, (None, 0))
+                if not location or (expiry and expiry < time.time()):
+                    break
+                url = location
+
+        return url
+
+    def send(self, method, url, headers, body):
+        import http.client
+        from urllib.parse import urlsplit
+        from urllib.request import proxy_bypass
+
+        parts = urlsplit(url)
+        precondition(parts.scheme in ("http", "https"), f"Unsupported url: {url}")
+
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+        origin = (parts.scheme, parts.hostname, port)
+        target = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+        # plain http proxies expect the absolute url as the request target
+        if parts.scheme == "http" and self.proxies.get("http") and not proxy_bypass(parts.hostname):
+            target = url
+
+        while True:
+            connection, reused = self.checkout(origin)
+            try:
+                connection.request(method, target, body=body, headers=headers)
+                response = connection.getresponse()
+            except (ConnectionError, http.client.RemoteDisconnected):
+                connection.close()
+                # idle connections may have been dropped by the server, in
+                # which case it's safe to try again on a fresh one
+                if reused and not hasattr(body, "read"):
+                    continue
+                raise
+            except:
+                connection.close()
+                raise
+
+            return PooledResponse(self, origin, connection, response)
+
+    def request(self, url, headers=None, method="GET", body=None):
+        from urllib.error import HTTPError
+        from urllib.parse import urljoin, urlsplit
+
+        headers = {"User-Agent": f"truck/{TRUCK_VERSION}", **(headers or {})}
+        host = urlsplit(url).hostname
+
+        for _ in range(self.MAX_REDIRECTS):
+            url = self.resolve(url)
+            # never leak credentials to whatever host we got redirected to
+            if urlsplit(url).hostname != host:
+                headers.pop("Authorization", None)
+
+            response = self.send(method, url, headers, body)
+            location = response.headers.get("Location")
+
+            if response.status in self.REDIRECT_CODES and location:
+                response.drain()
+                location = urljoin(url, location)
+                permanent = response.status in self.PERMANENT_REDIRECT_CODES
+                with self.lock:
+                    expiry = 0 if permanent else time.time() + self.REDIRECT_TTL
+                    self.redirects[url] = (location, expiry)
+
+                if response.status == 303:
+                    method, body = "GET", None
+                continue
+
+            if response.status >= 300:
+                body = response.drain()
+                raise HTTPError(url, response.status, response.reason, response.headers, io.BytesIO(body))
+
+            return response
+
+        raise HTTPError(url, 310, "Too many redirects", {}, None)
+
+
+class DownloadReader:
+    # file-like view over a (possibly resumed) download, yielding the bytes
+    # already on disk before the ones arriving from the network. Everything
+    # read is hashed, and network bytes are appended to the file on the way
+
+    def __init__(self, response, file, prefix_size, total_size, min_rate=None, cancelled=None):
+        self.response = response
+        self.file = file
+        self.prefix_remaining = prefix_size
+        self.total_size = total_size
+        self.min_rate = min_rate
+        # an Event set once the download isn't needed anymore
+        self.cancelled = cancelled
+        self.hashfun = hashlib.sha256()
+        self.size = 0
+        # bytes from the network, as opposed to the resumed prefix
+        self.received = 0
+        self.start_time = time.time()
+
+    def consumed(self, block):
+        self.hashfun.update(block)
+        self.size += len(block)
+        reporthook(self.size, self.total_size, self.start_time)
+
+    def received_block(self, size):
+        # gives up on sources much slower than the alternatives, which the
+        # download then resumes from
+        if self.cancelled and self.cancelled.is_set():
+            raise DownloadCancelled("cancelled")
+        self.received += size
+        duration = time.time() - self.start_time
+        rate = self.received / max(duration, 0.001)
+        if self.min_rate and duration > MIRROR_GRACE_PERIOD and rate < self.min_rate:
+            raise SlowDownload(f"{format_size(rate)}/s is too slow", rate)
+
+    def read(self, n=-1):
+        if n is None or n < 0:
+            return b"".join(iter(lambda: self.read(DOWNLOAD_BLOCK_SIZE), b""))
+
+        if self.prefix_remaining:
+            block = self.file.read(min(n, self.prefix_remaining))
+            # a short read means the file shrunk under us, which the final
+            # hash check will catch
+            self.prefix_remaining = self.prefix_remaining - len(block) if block else 0
+        else:
+            block = self.response.read(n)
+            if not block:
+                self.check_complete()
+            self.file.write(block)
+            self.received_block(len(block))
+
+        self.consumed(block)
+        return block
+
+    def check_complete(self):
+        # surfaces dropped connections as retryable errors, rather than as
+        # truncated payloads failing further down the line
+        import http.client
+        if self.total_size >= 0 and self.size != self.total_size:
+            raise http.client.IncompleteRead(b"", self.total_size - self.size)
+
+    def drain(self):
+        # reads whatever the consumer (if any) left, reusing a single large
+        # buffer rather than allocating per block
+        while self.prefix_remaining:
+            self.read(DOWNLOAD_BLOCK_SIZE)
+
+        buffer = memoryview(bytearray(DOWNLOAD_BLOCK_SIZE))
+        # cancellable downloads take whatever arrived, rather than blocking
+        # until the buffer fills, so they notice the cancellation promptly
+        readinto = self.response.readinto1 if self.cancelled else self.response.readinto
+        while True:
+            read = readinto(buffer)
+            if not read:
+                self.check_complete()
+                break
+
+            self.file.write(buffer[:read])
+            self.consumed(buffer[:read])
+            self.received_block(read)
 
-    url_session = FancyURLopener()
 
+def stream_download(url, filename, resume=False, headers=None, consume=None, min_rate=None, cancelled=None):
+    # writes the response to filename, hashing it in the same pass. When
+    # resuming, the bytes already in filename are kept, and only the rest
+    # is requested using a Range header. consume, when provided, is handed
+    # a file-like object to process the payload as it arrives
+    from urllib.error import HTTPError
+
+    size = os.path.getsize(filename) if resume and os.path.exists(filename) else 0
+    request_headers = dict(headers or {})
+    if size:
+        request_headers["Range"] = f"bytes={size}-"
+
+    try:
+        response = HttpTransport.shared().request(url, request_headers)
+    except HTTPError as e:
+        if e.code != 416:
+            raise
+        # the partial file is already complete (or bogus), start over
+        os.remove(filename)
+        return stream_download(url, filename, headers=headers, consume=consume, min_rate=min_rate, cancelled=cancelled)
+
+    with response:
+        if response.status != 206:
+            size = 0
+
+        with open(filename, "r+b" if size else "wb") as f:
+            expected_size = int(response.headers.get("Content-Length") or -1)
+            total_size = size + expected_size if expected_size >= 0 else -1
+
+            reader = DownloadReader(response, f, size, total_size, min_rate, cancelled)
+            if consume:
+                consume(reader)
+            reader.drain()
+
+    DownloadCache().record_throughput(url, reader.received, time.time() - reader.start_time)
+    return reader.hashfun.hexdigest(), reader.size, response.headers
+
+def is_retryable(error):
+    import http.client
+    from urllib.error import HTTPError
+
+    if isinstance(error, HTTPError):
+        return error.code >= 500 or error.code == 429
+    return isinstance(error, (DownloadError, OSError, http.client.HTTPException))
+
+def conditional_headers(entry):
+    headers = {}
+    if entry.get("etag"):
+        headers["If-None-Match"] = entry["etag"]
+    if entry.get("last_modified"):
+        headers["If-Modified-Since"] = entry["last_modified"]
+    return headers
+
+def consume_file(filename, consume):
+    if consume:
+        with open(filename, "rb") as f:
+            consume(f)
+
+def mirror_download(url, filename, resume, sha256, size, consume):
+    # fetches an immutable file through the MIRROR set up in ~/.truckrc (see
+    # truck serve), returning what stream_download does, or None when there
+    # is no mirror or it failed, leaving it to upstream
+    from urllib.parse import urlencode
+
+    mirror = Truck.secrets().get("MIRROR")
+    if not mirror or url.startswith(mirror):
+        return None
+
+    query = {"url": url}
+    if sha256:
+        query["sha256"] = sha256
+    if size is not None:
+        query["size"] = size
+
+    # a resumed partial download is kept for upstream to carry on with
+    start_size = os.path.getsize(filename) if resume and os.path.exists(filename) else 0
     try:
-        url_session.retrieve(url, filename, reporthook=reporthook)
+        result = stream_download(mirror.rstrip("/") + "/download?" + urlencode(query), filename, resume, consume=consume)
+        digest, downloaded_size, _ = result
+        if (sha256 and sha256 != digest) or (size is not None and size != downloaded_size):
+            raise IntegrityError("integrity check failed")
+        return result
     except Exception as e:
-        print("warning: {} failed to download".format(url))
-        print(e)
-        return
+        print(f"warning: {url} failed to download from the mirror ({e}), trying upstream")
+        if start_size:
+            os.truncate(filename, start_size)
+        elif os.path.exists(filename):
+            os.remove(filename)
+        return None
 
-    sys.stdout.write('\x1b[2K\r')
-    sys.stdout.write("... Downloaded " + filename + "\n")
-    sys.stdout.flush()
+def download(url, filename, check_cache=True, sha256=None, size=None, revalidate=False, consume=None, mirrors=(),
+             retries=DOWNLOAD_RETRIES, cancelled=None):
+    from urllib.error import HTTPError
+
+    cache = DownloadCache()
+
+    # mutable files (specs) are served from the cache while fresh, then
+    # revalidated with a conditional request, so an unchanged file costs a
+    # 304 rather than a full download
+    headers = {}
+    if revalidate:
+        entry = cache.entry_for_url(url) or {}
+        if time.time() - entry.get("validated", 0) >= cache.spec_ttl:
+            check_cache = False
+        if not check_cache:
+            headers = conditional_headers(entry)
+
+    tracer = Tracer.shared()
+    with tracer.span("download", url=url) as span:
+        with tracer.span("cache_fetch", url=url) if check_cache else NULL_SPAN:
+            hit = check_cache and cache.fetch_to(url, filename, sha256, size)
+        if hit:
+            span.update(cache="hit", bytes=os.path.getsize(filename))
+            consume_file(filename, consume)
+            return
+
+        with cache.partial_path(sha256) as (part_path, resumable):
+            span.update(cache="miss" if check_cache else "bypass", resumable=resumable)
+            # mutable files always come from upstream, as the mirror can't
+            # tell how stale its copy is
+            mirrored = None if revalidate else mirror_download(url, part_path, resumable, sha256, size, consume)
+            span["mirror"] = bool(mirrored)
+            # other urls serving the same content, tried in turn (resuming
+            # where the previous one stopped) when one fails or is too slow
+            sources = cache.rank_sources([url, *mirrors]) if mirrors else [url]
+            position = 0
+            # a wrong digest is retried once, in case the file was replaced
+            # mid download, but is most likely a stale spec
+            integrity_failures = 0
+            for attempt in range(retries):
+                if mirrored:
+                    digest, downloaded_size, response_headers = mirrored
+                    break
+                source = sources[position % len(sources)]
+                try:
+                    min_rate = cache.min_rate(sources, source) if len(sources) > 1 else None
+                    digest, downloaded_size, response_headers = stream_download(
+                        source, part_path, resumable, headers, consume, min_rate, cancelled
+                    )
+                    if (sha256 and sha256 != digest) or (size is not None and size != downloaded_size):
+                        os.remove(part_path)
+                        raise IntegrityError(f"{url} failed the integrity check")
+                    break
+                except Exception as e:
+                    if cancelled and cancelled.is_set():
+                        if not resumable and os.path.exists(part_path):
+                            os.remove(part_path)
+                        raise DownloadCancelled(f"{url} was cancelled") from e
+                    if isinstance(e, HTTPError) and e.code == 304:
+                        print(f"Not modified {url}")
+                        cache.mark_validated(url)
+                        if cache.fetch_to(url, filename):
+                            span.update(cache="not_modified", bytes=os.path.getsize(filename))
+                            consume_file(filename, consume)
+                            return
+                        # evicted in the meantime, ask for the whole thing
+                        headers = {}
+                        continue
+
+                    if isinstance(e, IntegrityError):
+                        integrity_failures += 1
+
+                    failover = len(sources) > 1
+                    switch = False
+                    if failover:
+                        cache.record_failure(source, getattr(e, "rate", 0))
+                        # a mirror missing the file won't get it by retrying
+                        if is_retryable(e):
+                            position += 1
+                        else:
+                            sources.remove(source)
+                        # backing off only once every source failed in a row
+                        switch = not is_retryable(e) or position % len(sources)
+
+                    if attempt == retries - 1 or not (is_retryable(e) or failover) or integrity_failures > 1:
+                        # keep resumable partials around for the next run
+                        if not resumable and os.path.exists(part_path):
+                            os.remove(part_path)
+                        if isinstance(e, DownloadError):
+                            raise
+                        raise DownloadError(f"{url} failed to download: {e}") from e
+
+                    if switch:
+                        print(f"warning: {source} failed to download ({e}), trying {sources[position % len(sources)]}")
+                        tracer.instant("failover", url=source, error=repr(e))
+                        continue
+
+                    delay = DOWNLOAD_BACKOFF * 2 ** attempt
+                    print(f"warning: {source} failed to download ({e}), retrying in {delay}s")
+                    tracer.instant("retry", url=url, error=repr(e), delay=delay)
+                    time.sleep(delay)
+            else:
+                # the last attempt was answered with a 304 for an entry evicted
+                # in the meantime, leaving nothing to store
+                if not resumable and os.path.exists(part_path):
+                    os.remove(part_path)
+                raise DownloadError(f"{url} was evicted from the cache while being revalidated")
+
+            if cancelled and cancelled.is_set():
+                if not resumable:
+                    os.remove(part_path)
+                raise DownloadCancelled(f"{url} was cancelled")
+
+            span.update(bytes=downloaded_size, attempts=attempt + 1, source=None if mirrored else source)
+            sys.stdout.write('\x1b[2K\r')
+            sys.stdout.write("... Downloaded " + filename + "\n")
+            sys.stdout.flush()
+
+            meta = None
+            if revalidate:
+                meta = {
+                    "etag": response_headers.get("ETag"),
+                    "last_modified": response_headers.get("Last-Modified"),
+                    "validated": time.time()
+                }
+
+            with tracer.span("cache_store", url=url, bytes=downloaded_size):
+                if not cache.store(url, part_path, sha256, meta, filename):
+                    shutil.move(part_path, filename)
+
+class MirrorFetch:
+    # an upstream download in progress on the mirror, which any number of
+    # clients stream from while it lands on disk
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "wb", buffering=0)
+        self.condition = threading.Condition()
+        self.size = 0
+        self.total_size = None
+        self.done = False
+        self.error = None
+
+    def open(self):
+        return open(self.path, "rb")
+
+    def download(self, url, sha256, size):
+        hashfun = hashlib.sha256()
+        with self.file, HttpTransport.shared().request(url) as response:
+            with self.condition:
+                self.total_size = int(response.headers.get("Content-Length") or -1)
+                self.condition.notify_all()
+
+            buffer = memoryview(bytearray(DOWNLOAD_BLOCK_SIZE))
+            while True:
+                read = response.readinto(buffer)
+                if not read:
+                    break
+                self.file.write(buffer[:read])
+                hashfun.update(buffer[:read])
+                with self.condition:
+                    self.size += read
+                    self.condition.notify_all()
+
+        if self.total_size >= 0 and self.size != self.total_size:
+            raise DownloadError(f"{url} was cut short")
+        if (sha256 and sha256 != hashfun.hexdigest()) or (size is not None and size != self.size):
+            raise IntegrityError(f"{url} failed the integrity check")
+
+    def finish(self, error=None):
+        with self.condition:
+            self.done = True
+            self.error = error
+            self.condition.notify_all()
+
+    def wait_for_headers(self):
+        with self.condition:
+            self.condition.wait_for(lambda: self.total_size is not None or self.done)
+            if self.error:
+                raise self.error
+            return self.total_size
+
+    def ready_size(self):
+        # the last byte is held back until the download is verified, so a
+        # failed one always reaches clients as a truncated response
+        return self.size if self.done else self.size - 1
+
+    def stream(self, f, wfile):
+        # sends whatever landed on disk so far, then waits for more
+        sent = 0
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.ready_size() > sent or self.done)
+                if self.error:
+                    raise self.error
+                available = self.ready_size() - sent
+                if not available:
+                    return
+
+            while available:
+                block = f.read(min(available, DOWNLOAD_BLOCK_SIZE))
+                wfile.write(block)
+                available -= len(block)
+                sent += len(block)
+
+
+class CacheMirror:
+    # serves the download cache over http as a read-through proxy, so that
+    # build machines sharing a network download every archive once (see
+    # truck serve and MIRROR). Misses are fetched upstream a single time,
+    # however many clients ask for them meanwhile, and streamed to all of
+    # them as the bytes arrive. Only archives of a known sha256, from the
+    # allowed hosts, are fetched, so the mirror can't be used as an open proxy
+
+    def __init__(self, allowed_hosts):
+        self.cache = DownloadCache()
+        self.allowed_hosts = allowed_hosts
+        self.lock = threading.Lock()
+        self.fetches = {}
+
+    def handle(self, request):
+        from urllib.parse import urlsplit, parse_qs
+
+        parts = urlsplit(request.path)
+        query = {name: values[0] for name, values in parse_qs(parts.query).items()}
+        url = query.get("url", "")
+        sha256 = query.get("sha256")
+        size = query.get("size")
+        if parts.path != "/download" or not url.startswith(("http://", "https://")):
+            return self.reply_error(request, 404, "Not Found")
+        if (sha256 and not re.fullmatch(r"[0-9a-f]{64}", sha256)) or (size and not size.isdigit()):
+            return self.reply_error(request, 400, "Bad Request")
+        size = size and int(size)
+
+        key = sha256 or self.cache.key_for_url(url)
+        with self.lock:
+            fetch = self.fetches.get(key)
+            if fetch:
+                outcome = "joined"
+            elif self.cache.contains(url, sha256):
+                outcome = "hit"
+            elif not sha256 or urlsplit(url).hostname not in self.allowed_hosts:
+                outcome = "refused"
+            else:
+                outcome = "miss"
+                fetch = self.fetches[key] = MirrorFetch(self.cache.temp_path())
+                threading.Thread(target=self.fetch, args=(key, fetch, url, sha256, size), daemon=True).start()
+            # opened while registered, before the fetch can move it into the cache
+            f = fetch and fetch.open()
+
+        print(f"{request.client_address[0]} {outcome} {url}")
+        if outcome == "refused":
+            return self.reply_error(request, 403, "Forbidden")
+        try:
+            if fetch:
+                with f:
+                    self.send_fetch(request, fetch, f)
+            else:
+                self.send_cached(request, url, sha256)
+        except (BrokenPipeError, ConnectionResetError):
+            request.close_connection = True
+
+    def fetch(self, key, fetch, url, sha256, size):
+        error = None
+        try:
+            fetch.download(url, sha256, size)
+        except Exception as e:
+            error = e
+            print(f"error: {url} failed to download ({e!r})")
+
+        with self.lock:
+            del self.fetches[key]
+            if not error:
+                self.cache.record_lookup(url, self.cache.cache_path_for_url(url, sha256), False)
+                self.cache.store(url, fetch.path, sha256)
+
+        fetch.finish(error)
+        if os.path.exists(fetch.path):
+            os.remove(fetch.path)
+
+    def reply_error(self, request, code, message):
+        body = message.encode()
+        request.send_response(code)
+        request.send_header("Content-Type", "text/plain")
+        request.send_header("Content-Length", str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+
+    def send_fetch(self, request, fetch, f):
+        try:
+            total_size = fetch.wait_for_headers()
+        except Exception:
+            return self.reply_error(request, 502, "Bad Gateway")
+
+        request.send_response(200)
+        if total_size >= 0:
+            request.send_header("Content-Length", str(total_size))
+        else:
+            request.send_header("Connection", "close")
+            request.close_connection = True
+        request.end_headers()
+
+        try:
+            fetch.stream(f, request.wfile)
+        except Exception:
+            # clients see a truncated response, and go upstream
+            request.close_connection = True
+
+    def send_cached(self, request, url, sha256):
+        try:
+            with self.cache.cached_file(url, sha256) as path, open(path, "rb") as f:
+                total_size = os.fstat(f.fileno()).st_size
+                # resumed downloads only ever ask for the rest of the file
+                match = re.fullmatch(r"bytes=(\d+)-", request.headers.get("Range", ""))
+                start = int(match.group(1)) if match else 0
+                if start >= total_size > 0:
+                    return self.reply_error(request, 416, "Range Not Satisfiable")
+
+                request.send_response(206 if start else 200)
+                if start:
+                    request.send_header("Content-Range", f"bytes {start}-{total_size - 1}/{total_size}")
+                request.send_header("Content-Length", str(total_size - start))
+                request.end_headers()
+                request.wfile.flush()
+                request.connection.sendfile(f, start)
+        except DownloadError:
+            # evicted since we looked
+            return self.reply_error(request, 404, "Not Found")
+
+        self.cache.record_lookup(url, self.cache.cache_path_for_url(url, sha256), True)
 
-    cache.store(url, filename)
 
 def simple_download(url):
-    req = urlopen(url)
-    return req.read()
+    with HttpTransport.shared().request(url) as response:
+        return response.read()
 
 def precondition(cond=False, msg=""):
     if not cond:
         print(msg)
         exit(1)
 
+class ThreadOutput:
+    # sys.stdout proxy which lets worker threads buffer whatever they print,
+    # so the main thread can replay it in a deterministic order
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    @property
+    def buffer(self):
+        return getattr(self.local, "buffer", None)
+
+    def capture(self):
+        self.local.buffer = io.StringIO()
+        return self.local.buffer
+
+    def release(self):
+        buffer = self.buffer
+        self.local.buffer = None
+        return buffer.getvalue() if buffer else ""
+
+    def isatty(self):
+        return not self.buffer and self.stream.isatty()
+
+    def write(self, text):
+        return (self.buffer or self.stream).write(text)
+
+    def flush(self):
+        if not self.buffer:
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+class TraceSpan:
+    # yields a dict of args, which the traced block can add to (byte counts,
+    # cache outcome) before the span is recorded on exit
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter() if self.tracer else 0
+        return self.args
+
+    def __exit__(self, error_type, error, traceback):
+        if not self.tracer:
+            return
+        if error_type:
+            self.args["error"] = repr(error)
+        self.tracer.emit({
+            "name": self.name,
+            "ph": "X",
+            "ts": self.tracer.timestamp(self.start),
+            "dur": round((time.perf_counter() - self.start) * 1e6),
+            "args": self.args
+        })
+
+
+NULL_SPAN = TraceSpan(None, None, {})
+
+
+class Tracer:
+    # records per-dep and per-phase spans in the Chrome trace event format,
+    # one event per line, to the file given with --trace or TRUCK_TRACE.
+    # Open it in ui.perfetto.dev or chrome://tracing. The format doesn't
+    # require the closing bracket, so a crashed run still leaves a usable
+    # trace. While disabled, spans record nothing
+
+    _shared = None
+
+    @classmethod
+    def shared(cls):
+        if not cls._shared:
+            cls._shared = Tracer()
+        return cls._shared
+
+    def __init__(self):
+        self.file = None
+        self.lock = threading.Lock()
+        self.threads = set()
+
+    def open(self, path):
+        self.file = open(path, "w")
+        self.file.write("[\n")
+        self.pid = os.getpid()
+        self.origin = time.perf_counter()
+        self.epoch = time.time()
+
+    def close(self, process_name="truck"):
+        if not self.file:
+            return
+        with self.lock:
+            self.file.write(json.dumps(
+                {"name": "process_name", "ph": "M", "pid": self.pid, "args": {"name": process_name}}
+            ) + "\n]\n")
+            self.file.close()
+            self.file = None
+
+    def timestamp(self, counter):
+        # microseconds since the epoch, so traces of separate runs line up
+        return round((self.epoch + counter - self.origin) * 1e6)
+
+    def span(self, name, **args):
+        return TraceSpan(self if self.file else None, name, args)
+
+    def instant(self, name, **args):
+        if self.file:
+            self.emit({"name": name, "ph": "i", "s": "t", "ts": self.timestamp(time.perf_counter()), "args": args})
+
+    def emit(self, event):
+        thread = threading.current_thread()
+        event.update(cat="truck", pid=self.pid, tid=thread.ident)
+        with self.lock:
+            if not self.file:
+                return
+            if thread.ident not in self.threads:
+                self.threads.add(thread.ident)
+                self.file.write(json.dumps(
+                    {"name": "thread_name", "ph": "M", "pid": self.pid, "tid": thread.ident, "args": {"name": thread.name}}
+                ) + ",\n")
+            self.file.write(json.dumps(event, default=str) + ",\n")
+
+
 class PathUtils:
 
     # file operations
@@ -156,6 +1849,532 @@ class PathUtils:
         with open(filepath, "w+") as f:
             f.write(json.dumps(config, indent=2) + "\n")
 
+    @classmethod
+    def remove(cls, path):
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+
+    @classmethod
+    def file_digest(cls, filepath):
+        hashfun = hashlib.sha256()
+        with open(filepath, "rb") as f:
+            for block in iter(lambda: f.read(DOWNLOAD_BLOCK_SIZE), b""):
+                hashfun.update(block)
+
+        return hashfun.hexdigest(), os.path.getsize(filepath)
+
+
+def member_name(name):
+    # normalizes an archive member name, refusing anything which would
+    # escape the extraction directory
+    parts = [p for p in name.split("/") if p not in ("", ".")]
+    if any(p == ".." for p in parts) or name.startswith("/"):
+        raise ValueError(f"Refusing to extract {name} outside of the target directory")
+    return "/".join(parts)
+
+def import_zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("tar.zst archives require zstandard (pip3 install zstandard)")
+    return zstandard
+
+def archive_format(filename):
+    for archive_format in ARCHIVE_FORMATS:
+        if filename.endswith("." + archive_format):
+            return archive_format
+    return "tar.gz" if filename.endswith(".tgz") else "zip"
+
+
+class TarExtractor:
+    # extracts a tar stream as it's being read, so extraction overlaps with
+    # the download. Computes the crc32 of every file on the way, producing
+    # the same manifest entries zip archives get from their central directory.
+    # Unlike zip members, streamed members can't be reordered to extract the
+    # symlinks last, so (like tarfile's "data" filter) members going through
+    # a symlink, and symlinks pointing outside of the root, are refused
+
+    def __init__(self, archive_format):
+        self.archive_format = archive_format
+
+    @staticmethod
+    def check_path(name, root, links):
+        # refuses to write name through one of the symlinks extracted so far,
+        # or anywhere outside of root
+        parts = name.split("/")
+        for i in range(1, len(parts) + 1):
+            if "/".join(parts[:i]) in links:
+                raise ValueError(f"Refusing to extract {name} through a symlink")
+
+        real_root = os.path.realpath(root)
+        parent = os.path.realpath(os.path.dirname(os.path.join(root, name)))
+        if os.path.commonpath([real_root, parent]) != real_root:
+            raise ValueError(f"Refusing to extract {name} outside of the target directory")
+
+    @staticmethod
+    def check_link(name, target):
+        if target.startswith("/") or os.path.isabs(target):
+            raise ValueError(f"Refusing to extract {name}, linking to the absolute path {target}")
+        resolved = os.path.normpath(os.path.join(os.path.dirname(name), target))
+        if resolved == ".." or resolved.startswith("../"):
+            raise ValueError(f"Refusing to extract {name}, linking outside of the target directory")
+
+    def extract(self, fileobj, root):
+        import tarfile
+
+        mode = "r|gz"
+        if self.archive_format == "tar.zst":
+            fileobj = import_zstandard().ZstdDecompressor().stream_reader(fileobj)
+            mode = "r|"
+
+        manifest = {}
+        links = set()
+        with tarfile.open(fileobj=fileobj, mode=mode) as tar:
+            for member in tar:
+                name = member_name(member.name)
+                if not name:
+                    continue
+
+                self.check_path(name, root, links)
+                path = os.path.join(root, name)
+                if member.isdir():
+                    os.makedirs(path, exist_ok=True)
+                    continue
+
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                if member.issym():
+                    self.check_link(name, member.linkname)
+                    os.symlink(member.linkname, path)
+                    links.add(name)
+                    data = member.linkname.encode()
+                    manifest[name] = [len(data), zlib.crc32(data)]
+                elif member.islnk():
+                    target = member_name(member.linkname)
+                    self.check_path(target, root, links)
+                    os.link(os.path.join(root, target), path)
+                    manifest[name] = manifest[target]
+                elif member.isfile():
+                    manifest[name] = [member.size, self.extract_file(tar, member, path)]
+
+        return manifest
+
+    def extract_file(self, tar, member, path):
+        crc = 0
+        with tar.extractfile(member) as src, open(path, "wb") as dst:
+            for block in iter(lambda: src.read(DOWNLOAD_BLOCK_SIZE), b""):
+                dst.write(block)
+                crc = zlib.crc32(block, crc)
+
+        os.chmod(path, member.mode & 0o777)
+        return crc
+
+
+class ZipExtractor:
+    # extracts zip members on a pool of threads, each with its own handle on
+    # the archive (zlib and file io release the GIL). Unlike extractall, it
+    # also restores the permissions and symlinks recorded by unix zip tools
+
+    def __init__(self, archive_path, jobs=None):
+        self.archive_path = archive_path
+        self.jobs = jobs or os.cpu_count() or 1
+
+    @staticmethod
+    def is_symlink(info):
+        return info.create_system == 3 and stat.S_ISLNK(info.external_attr >> 16)
+
+    @staticmethod
+    def target_path(info, root):
+        return os.path.join(root, member_name(info.filename))
+
+    def shard(self, infos):
+        # balances the shards by compressed size, largest members first
+        count = max(1, min(self.jobs, len(infos)))
+        shards = [[] for _ in range(count)]
+        loads = [0] * count
+        for info in sorted(infos, key=lambda i: i.compress_size, reverse=True):
+            index = loads.index(min(loads))
+            shards[index].append(info)
+            loads[index] += info.compress_size
+
+        return shards
+
+    def extract_file(self, zref, info, root):
+        path = self.target_path(info, root)
+        with zref.open(info) as src, open(path, "wb") as dst:
+            shutil.copyfileobj(src, dst)
+
+        mode = (info.external_attr >> 16) & 0o777
+        if info.create_system == 3 and mode:
+            os.chmod(path, mode)
+
+    def extract_shard(self, infos, root):
+        import zipfile
+        with zipfile.ZipFile(self.archive_path) as zref:
+            for info in infos:
+                self.extract_file(zref, info, root)
+
+    def link_targets(self, infos):
+        # the target of every symlink, checked before anything is extracted.
+        # They are held to the same rules as tar symlinks: nothing goes
+        # through them, and they don't point outside of root
+        import zipfile
+        links = {}
+        with zipfile.ZipFile(self.archive_path) as zref:
+            for info in infos:
+                if self.is_symlink(info):
+                    name = member_name(info.filename)
+                    links[name] = zref.read(info).decode()
+                    TarExtractor.check_link(name, links[name])
+
+        for info in infos if links else ():
+            parent = os.path.dirname(member_name(info.filename))
+            while parent:
+                if parent in links:
+                    raise ValueError(f"Refusing to extract {info.filename} through a symlink")
+                parent = os.path.dirname(parent)
+
+        return links
+
+    def extract(self, infos, root):
+        links = self.link_targets(infos)
+        # create every directory upfront, so workers never race on them
+        files = []
+        for info in infos:
+            path = self.target_path(info, root)
+            if info.is_dir():
+                os.makedirs(path, exist_ok=True)
+                continue
+
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if not self.is_symlink(info):
+                files.append(info)
+
+        shards = self.shard(files)
+        if len(shards) == 1:
+            self.extract_shard(shards[0], root)
+        else:
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers=len(shards)) as executor:
+                list(executor.map(lambda shard: self.extract_shard(shard, root), shards))
+
+        # symlinks go last, so files are never extracted through them
+        for name, target in links.items():
+            TarExtractor.check_path(name, root, ())
+            os.symlink(target, os.path.join(root, name))
+
+
+class ZipPackager:
+    # writes a zip straight from the source files, compressing its members on
+    # a pool of threads. Deflated members are split into fixed size chunks,
+    # all but the last ending with a full flush, so their raw deflate streams
+    # can simply be concatenated (as pigz does). bzip2 and lzma members are
+    # compressed whole, by a single worker each
+    CHUNK_SIZE = 1024 * 1024
+    SAMPLE_SIZE = 64 * 1024
+    SAMPLES = 8
+    # members deflating to more than this share of their size are stored
+    COMPRESSIBLE_RATIO = 0.95
+
+    def __init__(self, jobs=None, compression="deflate", level=None, store_incompressible=True):
+        import zipfile
+        self.jobs = jobs or os.cpu_count() or 1
+        self.compress_type = {
+            "deflate": zipfile.ZIP_DEFLATED,
+            "stored": zipfile.ZIP_STORED,
+            "bzip2": zipfile.ZIP_BZIP2,
+            "lzma": zipfile.ZIP_LZMA
+        }[compression]
+        self.level = level
+        self.store_incompressible = store_incompressible
+
+    @staticmethod
+    def members(files):
+        # (path, arcname) of every file and directory, rooted at the basenames
+        # of the configured paths. Symlinks are followed, like copytree did
+        members = []
+        for path in files:
+            name = os.path.basename(path)
+            members.append((path, name))
+            for root, dirs, filenames in os.walk(path, followlinks=True):
+                dirs.sort()
+                prefix = os.path.normpath(os.path.join(name, os.path.relpath(root, path)))
+                for filename in dirs + sorted(filenames):
+                    members.append((os.path.join(root, filename), os.path.join(prefix, filename)))
+
+        counts = Counter(name for _, name in members)
+        duplicates = sorted(name for name, count in counts.items() if count > 1)
+        precondition(not duplicates, "Duplicate archive entries: " + ", ".join(duplicates))
+        return members
+
+    def is_compressible(self, path, size):
+        # a quick deflate of samples spread across the file tells media,
+        # archives and the likes apart from mixed content like static libraries
+        step = max(size // self.SAMPLES, self.SAMPLE_SIZE // self.SAMPLES)
+        with open(path, "rb") as f:
+            sample = b""
+            for offset in range(0, size, step):
+                f.seek(offset)
+                sample += f.read(self.SAMPLE_SIZE // self.SAMPLES)
+        return len(zlib.compress(sample, 1)) < self.COMPRESSIBLE_RATIO * len(sample)
+
+    def chunks(self, members):
+        # (zinfo, zip64, task) in archive order, directories having a single
+        # None task. Everything the main thread relies on is set here, before
+        # any task is submitted; workers only ever update single task members
+        import zipfile
+        for path, name in members:
+            zinfo = zipfile.ZipInfo.from_file(path, name)
+            # same zip64 rule as ZipFile.open
+            zip64 = zinfo.file_size * 1.05 > zipfile.ZIP64_LIMIT
+            size, zinfo.file_size, zinfo.CRC = zinfo.file_size, 0, 0
+            if zinfo.is_dir():
+                yield zinfo, zip64, None
+                continue
+
+            zinfo.compress_type = self.compress_type
+            if self.compress_type in (zipfile.ZIP_BZIP2, zipfile.ZIP_LZMA):
+                yield zinfo, zip64, (self.compress_member, zinfo, path, size)
+                continue
+
+            # single chunk members are checked by their worker instead
+            if self.compress_type == zipfile.ZIP_DEFLATED and self.store_incompressible and \
+                    size > self.CHUNK_SIZE and not self.is_compressible(path, size):
+                zinfo.compress_type = zipfile.ZIP_STORED
+
+            for offset in range(0, max(size, 1), self.CHUNK_SIZE):
+                last = offset + self.CHUNK_SIZE >= size
+                yield zinfo, zip64, (self.compress_chunk, zinfo, path, offset, last)
+
+    def compress_chunk(self, zinfo, path, offset, last):
+        # returns the raw data, for the main thread to checksum, and its
+        # compressed payload
+        import zipfile
+        with open(path, "rb") as f:
+            f.seek(offset)
+            data = f.read(self.CHUNK_SIZE)
+        if zinfo.compress_type == zipfile.ZIP_STORED:
+            return data, data
+
+        level = zlib.Z_DEFAULT_COMPRESSION if self.level is None else self.level
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        flush = zlib.Z_FINISH if last else zlib.Z_FULL_FLUSH
+        payload = compressor.compress(data) + compressor.flush(flush)
+
+        if offset == 0 and last and self.store_incompressible and \
+                len(payload) >= self.COMPRESSIBLE_RATIO * len(data):
+            zinfo.compress_type = zipfile.ZIP_STORED
+            return data, data
+        return data, payload
+
+    def compress_member(self, zinfo, path, size):
+        # checksums and compresses a whole member into a spooled file, or
+        # hands back the source itself when it's not worth compressing
+        import bz2
+        import zipfile
+        import tempfile
+
+        with open(path, "rb") as f:
+            if self.store_incompressible and not self.is_compressible(path, size):
+                zinfo.compress_type = zipfile.ZIP_STORED
+                compressor = None
+                payload = open(path, "rb")
+            elif zinfo.compress_type == zipfile.ZIP_BZIP2:
+                compressor = bz2.BZ2Compressor(9 if self.level is None else self.level)
+            else:
+                compressor = zipfile.LZMACompressor()
+
+            if compressor:
+                payload = tempfile.SpooledTemporaryFile(max_size=self.CHUNK_SIZE)
+
+            for block in iter(lambda: f.read(self.CHUNK_SIZE), b""):
+                zinfo.CRC = zlib.crc32(block, zinfo.CRC)
+                zinfo.file_size += len(block)
+                if compressor:
+                    payload.write(compressor.compress(block))
+            if compressor:
+                payload.write(compressor.flush())
+
+        payload.seek(0)
+        return None, payload
+
+    def submit(self, executor, chunks):
+        # keeps a bounded number of tasks in flight, yielding them in order
+        window = deque()
+        for zinfo, zip64, task in chunks:
+            window.append((zinfo, zip64, task and executor.submit(*task)))
+            if len(window) > 2 * self.jobs:
+                yield window.popleft()
+        yield from window
+
+    @staticmethod
+    def start_member(zref, zinfo, zip64):
+        # writes a placeholder local header, the sizes are only known once
+        # the data is written
+        zinfo.header_offset = zref.fp.tell()
+        zref.fp.write(zinfo.FileHeader(zip64))
+
+    @staticmethod
+    def finish_member(zref, zinfo, zip64):
+        # rewrites the local header, then registers the member with the
+        # ZipFile so that close() writes it to the central directory
+        end = zref.fp.tell()
+        zref.fp.seek(zinfo.header_offset)
+        zref.fp.write(zinfo.FileHeader(zip64))
+        zref.fp.seek(end)
+        zref.filelist.append(zinfo)
+        zref.NameToInfo[zinfo.filename] = zinfo
+        zref.start_dir = end
+
+    def write(self, archive_path, files):
+        import zipfile
+        from concurrent.futures import ThreadPoolExecutor
+
+        members = self.members(files)
+        with zipfile.ZipFile(archive_path, "w") as zref, \
+                ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            member = None
+            for zinfo, zip64, future in self.submit(executor, self.chunks(members)):
+                if zinfo is not member:
+                    if member:
+                        self.finish_member(zref, member, member_zip64)
+                    self.start_member(zref, zinfo, zip64)
+                    member, member_zip64 = zinfo, zip64
+                if not future:
+                    continue
+
+                data, payload = future.result()
+                if data is not None:
+                    zinfo.CRC = zlib.crc32(data, zinfo.CRC)
+                    zinfo.file_size += len(data)
+                if isinstance(payload, bytes):
+                    zref.fp.write(payload)
+                    zinfo.compress_size += len(payload)
+                else:
+                    with payload:
+                        shutil.copyfileobj(payload, zref.fp)
+                        zinfo.compress_size += payload.tell()
+            if member:
+                self.finish_member(zref, member, member_zip64)
+
+
+class ArchiveDelta:
+    # zip aware binary deltas. The new archive is described as byte ranges
+    # copied from an older one, for members whose compressed data didn't
+    # change, and literal bytes for everything else (headers, new members and
+    # the central directory). Applying one is a sequential copy, verified
+    # against the new archive's sha256
+    MAGIC = b"TRUCKDELTA1"
+    COPY = b"C"
+    DATA = b"D"
+    END = b"E"
+    # members smaller than this aren't worth a copy
+    MIN_COPY_SIZE = 64
+
+    @staticmethod
+    def data_ranges(path):
+        # (offset, size, crc) of every member's compressed data, in file order
+        import struct
+        import zipfile
+
+        ranges = []
+        with zipfile.ZipFile(path) as zref, open(path, "rb") as f:
+            for info in sorted(zref.infolist(), key=lambda i: i.header_offset):
+                f.seek(info.header_offset + 26)
+                name_size, extra_size = struct.unpack("<HH", f.read(4))
+                offset = info.header_offset + 30 + name_size + extra_size
+                ranges.append((offset, info.compress_size, info.CRC))
+        return ranges
+
+    @staticmethod
+    def range_digest(f, offset, size):
+        f.seek(offset)
+        hashfun = hashlib.sha256()
+        while size > 0:
+            block = f.read(min(size, DOWNLOAD_BLOCK_SIZE))
+            precondition(block, f"Unexpected end of {f.name}")
+            hashfun.update(block)
+            size -= len(block)
+        return hashfun.digest()
+
+    @staticmethod
+    def copy_range(src, dst, offset, size, hashfun=None):
+        src.seek(offset)
+        while size > 0:
+            block = src.read(min(size, DOWNLOAD_BLOCK_SIZE))
+            if not block:
+                raise DownloadError(f"Unexpected end of {src.name}")
+            dst.write(block)
+            if hashfun:
+                hashfun.update(block)
+            size -= len(block)
+
+    @classmethod
+    def create(cls, old_path, new_path, delta_path):
+        import struct
+
+        # old members by crc and size, confirmed byte for byte below
+        old_ranges = {}
+        for offset, size, crc in cls.data_ranges(old_path):
+            old_ranges.setdefault((crc, size), []).append(offset)
+
+        old_sha256, _ = PathUtils.file_digest(old_path)
+        new_sha256, new_size = PathUtils.file_digest(new_path)
+
+        with open(old_path, "rb") as old, open(new_path, "rb") as new, open(delta_path, "wb") as delta:
+            delta.write(cls.MAGIC + bytes.fromhex(old_sha256) + bytes.fromhex(new_sha256))
+
+            def write_data(offset, end):
+                if end > offset:
+                    delta.write(cls.DATA + struct.pack("<Q", end - offset))
+                    cls.copy_range(new, delta, offset, end - offset)
+
+            position = 0
+            for offset, size, crc in cls.data_ranges(new_path):
+                if size < cls.MIN_COPY_SIZE:
+                    continue
+                digest = cls.range_digest(new, offset, size)
+                for old_offset in old_ranges.get((crc, size), []):
+                    if cls.range_digest(old, old_offset, size) == digest:
+                        write_data(position, offset)
+                        delta.write(cls.COPY + struct.pack("<QQ", old_offset, size))
+                        position = offset + size
+                        break
+
+            write_data(position, new_size)
+            delta.write(cls.END)
+
+        return os.path.getsize(delta_path)
+
+    @classmethod
+    def apply(cls, old_path, old_sha256, delta_path, new_path):
+        # rebuilds the new archive, returning its sha256 and size
+        import struct
+
+        hashfun = hashlib.sha256()
+        with open(old_path, "rb") as old, open(delta_path, "rb") as delta, open(new_path, "wb") as new:
+            header = delta.read(len(cls.MAGIC) + 64)
+            if not header.startswith(cls.MAGIC):
+                raise DownloadError(f"{delta_path} isn't a truck delta")
+            if header[len(cls.MAGIC):len(cls.MAGIC) + 32].hex() != old_sha256:
+                raise DownloadError(f"{delta_path} doesn't apply to {old_path}")
+
+            while True:
+                op = delta.read(1)
+                if op == cls.COPY:
+                    offset, size = struct.unpack("<QQ", delta.read(16))
+                    cls.copy_range(old, new, offset, size, hashfun)
+                elif op == cls.DATA:
+                    size, = struct.unpack("<Q", delta.read(8))
+                    cls.copy_range(delta, new, delta.tell(), size, hashfun)
+                elif op == cls.END:
+                    break
+                else:
+                    raise DownloadError(f"{delta_path} is corrupt")
+
+            return hashfun.hexdigest(), new.tell()
+
 
 class TruckAction:
 
@@ -163,17 +2382,39 @@ class TruckAction:
     def print_actions(actions):
         print("\n".join([str(a) for a in actions]))
 
-    def __init__(self, name, arg_count, eg, description, callback):
+    @staticmethod
+    def parse_args(args):
+        # splits "--name value" pairs out of the positional arguments
+        positional = []
+        options = {}
+        args = iter(args)
+        for arg in args:
+            if arg.startswith("--"):
+                options[arg[2:]] = next(args, None)
+            else:
+                positional.append(arg)
+
+        return positional, options
+
+    def __init__(self, name, arg_count, eg, description, callback, options=()):
         self.name = name
         self.arg_count = arg_count
         self.eg = eg
         self.description = description
         self.callback = callback
+        self.options = options
 
     def __str__(self):
         return self.name + " - " + self.description + " (e.g. " + self.eg + ")"
 
     def trigger(self, args):
+        args, options = TruckAction.parse_args(args)
+
+        # every action can be traced
+        trace_path = options.pop("trace", False)
+        if trace_path is None:
+            precondition(msg="--trace expects a value")
+        trace_path = trace_path or os.environ.get("TRUCK_TRACE")
 
         if isinstance(self.arg_count, int):
             range_ = [self.arg_count]
@@ -183,19 +2424,270 @@ class TruckAction:
         if len(args) not in range_:
             precondition(msg=f"{self.name} expects {self.arg_count} arguments")
 
-        self.callback(*args)
+        for name, value in options.items():
+            if name not in self.options:
+                precondition(msg=f"{self.name} doesn't support --{name}")
+            if value is None:
+                precondition(msg=f"--{name} expects a value")
+
+        if not trace_path:
+            self.callback(*args, **options)
+            return
+
+        tracer = Tracer.shared()
+        tracer.open(trace_path)
+        try:
+            with tracer.span(self.name, args=args, **options):
+                self.callback(*args, **options)
+        finally:
+            tracer.close(f"truck {self.name}")
+
+
+class TruckState:
+    # Truck/.state pins the version and top level files of every synced dep
+    # in a single compact file, along with a fingerprint of truck.json (and
+    # ~/.truckrc, which may override versions) as of the last time the deps
+    # were checked. That's enough for truck check to answer with a couple of
+    # stats and a single read. The (larger) per file manifests are kept in
+    # Truck/.manifests, and only read when a dep is updated
+
+    SHARED = None
+
+    @classmethod
+    def shared(cls):
+        if not cls.SHARED:
+            cls.SHARED = cls()
+        return cls.SHARED
+
+    @staticmethod
+    def file_signature(filepath):
+        try:
+            stat = os.stat(filepath)
+        except FileNotFoundError:
+            return None
+        return [stat.st_mtime_ns, stat.st_size]
+
+    @classmethod
+    def config_fingerprint(cls, config_filepath):
+        with open(config_filepath, "rb") as f:
+            sha256 = hashlib.sha256(f.read()).hexdigest()
+
+        return {
+            "config": cls.file_signature(config_filepath),
+            "sha256": sha256,
+            "secrets": cls.file_signature(TRUCK_SECRETS_FILEPATH),
+            "lock": cls.file_signature(TRUCK_LOCK_FILENAME)
+        }
+
+    @classmethod
+    def cached_check(cls, config_filepath):
+        # whether the deps were in sync according to the fingerprint, or None
+        # if it can't vouch for the current truck.json
+        try:
+            with open(TRUCK_STATE_FILEPATH) as f:
+                state = json.loads(f.read())
+            signature = cls.file_signature(config_filepath)
+        except (FileNotFoundError, ValueError):
+            return None
+
+        fingerprint = state.get("fingerprint")
+        if not fingerprint or not signature:
+            return None
+        # symlinked deps are only as good as their trees, which any checkout
+        # may have removed from the store
+        for meta in state.get("deps", {}).values():
+            if meta.get("tree") == "symlink" and not os.path.isdir(TreeStore().tree_path(meta["sha256"])):
+                return None
+        if fingerprint["secrets"] != cls.file_signature(TRUCK_SECRETS_FILEPATH):
+            return None
+        if fingerprint.get("lock") != cls.file_signature(TRUCK_LOCK_FILENAME):
+            return None
+        # a touched but otherwise identical truck.json is still fine
+        if fingerprint["config"] != signature:
+            if cls.config_fingerprint(config_filepath)["sha256"] != fingerprint["sha256"]:
+                return None
+
+        return state["in_sync"]
+
+    def __init__(self):
+        self.fingerprint = None
+        self.in_sync = False
+        self.deps = {}
+        self.load()
+
+    def load(self):
+        try:
+            with open(TRUCK_STATE_FILEPATH) as f:
+                state = json.loads(f.read())
+        except FileNotFoundError:
+            self.migrate()
+            return
+
+        self.fingerprint = state.get("fingerprint")
+        self.in_sync = state.get("in_sync", False)
+        self.deps = state.get("deps", {})
+
+    def migrate(self):
+        # imports the per dep .version files written by older trucks
+        if not os.path.isdir(TRUCK_ROOT_DIRECTORY):
+            return
+
+        for filename in os.listdir(TRUCK_ROOT_DIRECTORY):
+            if not filename.endswith(".version"):
+                continue
+
+            filepath = os.path.join(TRUCK_ROOT_DIRECTORY, filename)
+            with open(filepath) as f:
+                meta = json.loads(f.read())
+
+            name = os.path.splitext(filename)[0]
+            self.deps[name] = {"version": meta["version"], "files": meta["files"]}
+            if "manifest" in meta:
+                self.write_manifest(name, meta["manifest"])
+
+        self.save()
+        for filename in os.listdir(TRUCK_ROOT_DIRECTORY):
+            if filename.endswith(".version"):
+                os.remove(os.path.join(TRUCK_ROOT_DIRECTORY, filename))
+
+    def save(self):
+        if not os.path.isdir(TRUCK_ROOT_DIRECTORY):
+            return
+
+        tmp_path = TRUCK_STATE_FILEPATH + ".tmp"
+        with open(tmp_path, "w+") as f:
+            f.write(json.dumps({
+                "fingerprint": self.fingerprint,
+                "in_sync": self.in_sync,
+                "deps": self.deps
+            }))
+        os.replace(tmp_path, TRUCK_STATE_FILEPATH)
+
+    def update_fingerprint(self, config_filepath, in_sync):
+        self.fingerprint = self.config_fingerprint(config_filepath)
+        self.in_sync = in_sync
+        self.save()
+
+    def manifest_path(self, name):
+        return os.path.join(TRUCK_MANIFESTS_DIRECTORY, name + ".json")
+
+    def load_manifest(self, name):
+        try:
+            with open(self.manifest_path(name)) as f:
+                return json.loads(f.read())
+        except FileNotFoundError:
+            return None
+
+    def write_manifest(self, name, manifest):
+        os.makedirs(TRUCK_MANIFESTS_DIRECTORY, exist_ok=True)
+        with open(self.manifest_path(name), "w+") as f:
+            f.write(json.dumps(manifest))
+
+    def get(self, name):
+        meta = self.deps.get(name)
+        return dict(meta) if meta else None
+
+    def pin(self, name, version, files, manifest, sha256=None, tree=None):
+        # tree is how the files are linked to the TreeStore, if they are
+        self.write_manifest(name, manifest)
+        self.deps[name] = {"version": version, "files": files}
+        if sha256:
+            self.deps[name]["sha256"] = sha256
+        if tree:
+            self.deps[name]["tree"] = tree
+        self.fingerprint = None
+        self.save()
+
+    def unpin(self, name):
+        # keeps the files and manifest around, so an interrupted update can
+        # resume where it left off, while marking the dep as out of sync
+        self.deps[name]["version"] = None
+        self.fingerprint = None
+        self.save()
+
+    def remove(self, name):
+        self.deps.pop(name, None)
+        try:
+            os.remove(self.manifest_path(name))
+        except FileNotFoundError:
+            pass
+        self.fingerprint = None
+        self.save()
+
+
+class TruckLock:
+    # truck.lock records what the deps in truck.json resolved to: the spec
+    # entries of their version, and of the versions it has deltas from. Sync
+    # then goes straight to the archives, without fetching any spec. An
+    # entry only applies while the dep's url and version, and the version
+    # SWIFT_VERSION_OVERRIDE turned it into, are the ones it was resolved for
+
+    SHARED = None
+
+    @classmethod
+    def shared(cls):
+        if not cls.SHARED:
+            cls.SHARED = cls()
+        return cls.SHARED
+
+    def __init__(self):
+        try:
+            with open(TRUCK_LOCK_FILENAME) as f:
+                self.deps = json.loads(f.read(), object_pairs_hook=OrderedDict)
+        except (FileNotFoundError, ValueError):
+            self.deps = OrderedDict()
+        self.changed = False
+
+    def get(self, dep):
+        # the locked spec of dep, or None
+        entry = self.deps.get(dep.name)
+        if not entry or [entry["url"], entry["version"], entry["resolved"]] != [dep.spec_url, dep.raw_version, dep.version]:
+            return None
+        return entry["spec"]
+
+    def lock(self, dep):
+        entry = dep.binary_entry
+        spec = OrderedDict({dep.version: dep.spec_json[dep.version]})
+        for base in entry.get("deltas", {}):
+            base_entry = dep.spec_entry(base)
+            spec[base] = {key: value for key, value in base_entry.items() if key != "deltas"}
+
+        locked = OrderedDict({"url": dep.spec_url, "version": dep.raw_version, "resolved": dep.version, "spec": spec})
+        if self.deps.get(dep.name) != locked:
+            self.deps[dep.name] = locked
+            self.changed = True
+
+    def unlock(self, name):
+        if self.deps.pop(name, None):
+            self.changed = True
+
+    def save(self, deps):
+        # keeps the deps of truck.json, in its order
+        names = [dep.name for dep in deps]
+        deps = OrderedDict((name, self.deps[name]) for name in names if name in self.deps)
+        if not self.changed and list(deps) == list(self.deps):
+            return
+
+        self.deps = deps
+        self.changed = False
+        tmp_path = TRUCK_LOCK_FILENAME + ".tmp"
+        with open(tmp_path, "w+") as f:
+            f.write(json.dumps(self.deps, indent=2) + "\n")
+        os.replace(tmp_path, TRUCK_LOCK_FILENAME)
 
 
 class TruckDep:
-    def __init__(self, version=None, url=None, name=None):
+    def __init__(self, version=None, url=None, name=None, mirrors=None):
         # version and url provided from truck.json, while name is provided for
-        # deps that are downloaded and enumerated from disk
+        # deps that are downloaded and enumerated from disk. mirrors are
+        # optional urls of the same spec, published to other hosts
         precondition(bool(version and url) != bool(name), "URL xor name required")
         # in case the version is provided from truck.json, let's allow for the
         # user to override the Swift version outside of git
         processed_version = version and Truck.process_version(version)
 
         self.spec_url = url
+        self.spec_mirrors = mirrors or []
         self.name = name or os.path.splitext(self.spec_filename)[0]
 
         self.old_spec = self.load_old_spec()
@@ -204,7 +2696,17 @@ class TruckDep:
         self.raw_version = version
 
         self.spec_json = {}
+        # "lock" or "index" when spec_json comes from truck.lock or an
+        # index.json rather than the dep's own spec, either of which may be
+        # outdated
+        self.spec_source = None
         self.binary_filelist = []
+        self.binary_manifest = {}
+        # only tar archives are extracted while downloading, into the
+        # staging path, producing this manifest
+        self.staged_manifest = None
+        # the manifest of the archive's tree in the TreeStore, once there
+        self.tree = None
 
     def __repr__(self):
         return str(self)
@@ -212,9 +2714,24 @@ class TruckDep:
     def __str__(self):
         return f"{self.name} ({self.version})"
 
+    @staticmethod
+    def spec_entry_of(spec_json, version):
+        # versions are either plain urls, or dicts carrying a url along with
+        # the archive's sha256 and size (and deltas from older versions, and
+        # the urls of its mirrors) for releases made by newer trucks
+        entry = spec_json[version]
+        return {"url": entry} if isinstance(entry, str) else entry
+
+    def spec_entry(self, version):
+        return self.spec_entry_of(self.spec_json, version)
+
+    @property
+    def binary_entry(self):
+        return self.spec_entry(self.version)
+
     @property
     def binary_url(self):
-        return self.spec_json[self.version]
+        return self.binary_entry["url"]
 
     @property
     def spec_filename(self):
@@ -224,10 +2741,6 @@ class TruckDep:
     def binary_filename(self):
         return os.path.basename(self.binary_url)
 
-    @property
-    def version_filepath(self):
-        return os.path.join(TRUCK_ROOT_DIRECTORY, self.name + ".version")
-
     @property
     def spec_path(self):
         return os.path.join(TRUCK_TMP_DIRECTORY, self.spec_filename)
@@ -236,10 +2749,19 @@ class TruckDep:
     def binary_path(self):
         return os.path.join(TRUCK_TMP_DIRECTORY, self.binary_filename)
 
+    @property
+    def binary_format(self):
+        return archive_format(self.binary_filename)
+
     @property
     def binary_zipfile(self):
+        import zipfile
         return zipfile.ZipFile(self.binary_path, 'r')
 
+    @property
+    def staging_path(self):
+        return os.path.join(TRUCK_TMP_DIRECTORY, self.name + ".staged")
+
     @property
     def extraction_path(self):
         return TRUCK_ROOT_DIRECTORY
@@ -247,51 +2769,234 @@ class TruckDep:
     @property
     def json(self):
         # let's guarantee the key order
-        return OrderedDict({"url": self.spec_url, "version": self.raw_version})
+        json = OrderedDict({"url": self.spec_url, "version": self.raw_version})
+        if self.spec_mirrors:
+            json["mirrors"] = self.spec_mirrors
+        return json
 
     @property
     def is_out_of_sync(self):
-        if not os.path.isfile(self.version_filepath):
+        meta = TruckState.shared().get(self.name)
+        if not meta or meta["version"] != self.version:
+            return True
+        # symlinked files are gone along with their tree
+        if meta.get("tree") == "symlink" and not os.path.isdir(TreeStore().tree_path(meta["sha256"])):
             return True
 
-        with open(self.version_filepath) as f:
-            meta = json.loads(f.read())
+        # the version was released again since it was synced, according to
+        # an updated truck.lock
+        locked = TruckLock.shared().get(self)
+        sha256 = locked and self.spec_entry_of(locked, self.version).get("sha256")
+        return bool(sha256 and meta.get("sha256") and sha256 != meta["sha256"])
 
-        return meta["version"] != self.version
+    @cached_property
+    def old_manifest(self):
+        return TruckState.shared().load_manifest(self.name)
 
     def update_version(self, new_version):
         # make sure to change raw_version only, this is for disk needs only
         self.raw_version = new_version
 
     def load_old_spec(self):
-        if not os.path.isfile(self.version_filepath):
-            return None
-
-        with open(self.version_filepath) as f:
-            return json.loads(f.read())
+        return TruckState.shared().get(self.name)
+
+    def fetch_spec(self, url, check_cache, retries=DOWNLOAD_RETRIES, path=None, cancelled=None):
+        # raises unless the spec parses and lists our version
+        path = path or self.spec_path
+        download(url, path, check_cache, revalidate=True, retries=retries, cancelled=cancelled)
+
+        with open(path) as f:
+            spec_json = json.loads(f.read())
+        _ = spec_json[self.version]
+        return spec_json
+
+    def race_specs(self, check_cache):
+        # asks every host at once, a single time, and the first valid spec
+        # wins. Each request buffers its output, and only the winner's is
+        # kept. The others are cancelled, and given SPEC_RACE_GRACE_PERIOD to
+        # wind down. They download into temporary files of their own, so
+        # stragglers never leave anything behind in Truck/Tmp
+        import queue
+
+        stdout = sys.stdout
+        output = stdout if isinstance(stdout, ThreadOutput) else ThreadOutput(stdout)
+        sys.stdout = output
+        results = queue.Queue()
+        cancelled = threading.Event()
+
+        def fetch(url):
+            output.capture()
+            cache = DownloadCache()
+            path = os.path.join(cache.tmp_dir, f"{os.getpid()}-{cache.key_for_url(url)}-{self.spec_filename}")
+            spec_json, error = None, None
+            try:
+                spec_json = self.fetch_spec(url, check_cache, retries=1, path=path, cancelled=cancelled)
+            except Exception as e:
+                error = e
+            finally:
+                if os.path.exists(path):
+                    os.remove(path)
+            results.put((spec_json, error, output.release()))
+
+        urls = [self.spec_url, *self.spec_mirrors]
+        threads = [threading.Thread(target=fetch, args=(url,), daemon=True) for url in urls]
+        for thread in threads:
+            thread.start()
+
+        winner = None
+        try:
+            for _ in urls:
+                spec_json, error, captured = results.get()
+                if not error:
+                    winner = spec_json
+                    break
+        finally:
+            cancelled.set()
+            deadline = time.time() + SPEC_RACE_GRACE_PERIOD
+            for thread in threads:
+                thread.join(max(0, deadline - time.time()))
+            # stragglers keep printing into their (discarded) buffers for as
+            # long as they run, which needs the proxy to stay in place
+            if not any(thread.is_alive() for thread in threads):
+                sys.stdout = stdout
+
+        if winner is not None:
+            sys.stdout.write(captured)
+            return winner
+
+        # every host failed at once, the main one gets the usual retries
+        return self.fetch_spec(self.spec_url, check_cache)
 
     def download_spec(self, check_cache=True):
-        download(self.spec_url, self.spec_path, check_cache)
-
-        with open(self.spec_path) as f:
+        with Tracer.shared().span("spec", dep=self.name, hosts=1 + len(self.spec_mirrors)):
             try:
-                self.spec_json = json.loads(f.read())
-            except:
-                self.spec_json = {}
-
-        # check if spec json is missing the spec version
-        # if it is, we need to check remote for a newer version
-        try:
-            _ = self.binary_url
-        except KeyError:
-            if check_cache:
+                if self.spec_mirrors:
+                    self.spec_json = self.race_specs(check_cache)
+                else:
+                    self.spec_json = self.fetch_spec(self.spec_url, check_cache)
+            except (KeyError, ValueError):
+                # the spec might be missing the version, in which case we
+                # need to check remote for a newer one
+                if not check_cache:
+                    raise
                 print("Possible stale spec cache...")
                 self.download_spec(False)
-            else:
-                raise
+
+    def stage_archive(self, fileobj):
+        # may be called again when a download is retried
+        shutil.rmtree(self.staging_path, ignore_errors=True)
+        os.makedirs(self.staging_path)
+        extractor = TarExtractor(self.binary_format)
+        with Tracer.shared().span("stage", dep=self.name) as span:
+            self.staged_manifest = extractor.extract(fileobj, self.staging_path)
+            span["files"] = len(self.staged_manifest)
+
+    def delta_plan(self, cache):
+        # the cheapest chain of deltas leading to this version from any
+        # archive in the cache, as (base, version) hops. None when there's
+        # no chain smaller than the archive itself
+        import heapq
+
+        entries = {version: self.spec_entry(version) for version in self.spec_json}
+        queue = [
+            (0, version, []) for version, entry in entries.items()
+            if entry.get("sha256") and cache.contains(entry["url"], entry["sha256"])
+        ]
+        heapq.heapify(queue)
+
+        visited = set()
+        while queue:
+            cost, base, hops = heapq.heappop(queue)
+            if cost >= self.binary_entry["size"]:
+                break
+            if base == self.version:
+                return hops
+            if base in visited:
+                continue
+            visited.add(base)
+
+            for version, entry in entries.items():
+                delta = entry.get("deltas", {}).get(base)
+                if delta and version not in visited:
+                    heapq.heappush(queue, (cost + delta["size"], version, hops + [(base, version)]))
+
+        return None
+
+    def patch_binary(self):
+        # rebuilds the archive from an older one in the cache when that's
+        # cheaper than downloading it, returning whether it did. Every
+        # archive along the way is verified and cached like a download
+        entry = self.binary_entry
+        if self.binary_format != "zip" or not entry.get("sha256") or not entry.get("size"):
+            return False
+
+        cache = DownloadCache()
+        if cache.contains(entry["url"], entry["sha256"]):
+            return False
+
+        hops = self.delta_plan(cache)
+        if not hops:
+            return False
+
+        try:
+            for base, version in hops:
+                base_entry = self.spec_entry(base)
+                target_entry = self.spec_entry(version)
+                delta = target_entry["deltas"][base]
+                print(f"Patching {self.name} {base} -> {version}")
+
+                delta_path = os.path.join(TRUCK_TMP_DIRECTORY, os.path.basename(delta["url"]))
+                patched_path = cache.temp_path()
+                try:
+                    with Tracer.shared().span("patch", dep=self.name, base=base, version=version):
+                        download(
+                            delta["url"], delta_path, sha256=delta["sha256"], size=delta["size"],
+                            mirrors=delta.get("mirrors", ())
+                        )
+                        with cache.cached_file(base_entry["url"], base_entry["sha256"]) as base_path:
+                            sha256, size = ArchiveDelta.apply(base_path, base_entry["sha256"], delta_path, patched_path)
+                    if sha256 != target_entry["sha256"] or size != target_entry["size"]:
+                        raise IntegrityError(f"{version} failed the integrity check")
+                    if not cache.store(target_entry["url"], patched_path, sha256):
+                        raise DownloadError("failed to cache the patched archive")
+                finally:
+                    for path in (delta_path, patched_path):
+                        if os.path.exists(path):
+                            os.remove(path)
+        except Exception as e:
+            print(f"warning: {self.name} couldn't be patched ({e}), downloading the whole archive")
+            return False
+
+        return cache.fetch_to(entry["url"], self.binary_path, entry["sha256"], entry["size"])
 
     def download_binary(self):
-        download(self.binary_url, self.binary_path)
+        entry = self.binary_entry
+        streamed = self.binary_format != "zip"
+        if entry.get("sha256") and TreeStore().link_mode:
+            self.tree = TreeStore().load(entry["sha256"])
+        if self.tree:
+            print(f"Tree store hit! {self.binary_url}")
+            Tracer.shared().instant("tree_hit", dep=self.name, version=self.version)
+            self.binary_filelist = self.tree["top_level"]
+            return
+
+        # the full download is the fallback for anything a delta can't do
+        with Tracer.shared().span("binary", dep=self.name, version=self.version) as span:
+            span["patched"] = self.patch_binary()
+            if not span["patched"]:
+                download(
+                    self.binary_url,
+                    self.binary_path,
+                    sha256=entry.get("sha256"),
+                    size=entry.get("size"),
+                    consume=self.stage_archive if streamed else None,
+                    mirrors=entry.get("mirrors", ())
+                )
+
+        if streamed:
+            self.binary_filelist = os.listdir(self.staging_path)
+            return
+
         all_files = self.binary_zipfile.namelist()
         top_level = set([f.split("/")[0] for f in all_files])
         self.binary_filelist = list(top_level)
@@ -319,15 +3024,15 @@ class ClientConfig:
 
 class Truck:
     SECRETS = None
+    SWIFT_VERSION_PATTERN = re.compile(r"\d+(\.\d+)+-\d+(\.\d+)+-\d+(\.\d+)+$")
 
     @classmethod
     def secrets(cls):
         if cls.SECRETS:
             return cls.SECRETS
 
-        truck_secrets_filepath = os.path.expanduser("~/.truckrc")
         cls.SECRETS = PathUtils.open_or_create_json_file(
-            truck_secrets_filepath, TRUCK_SECRETS_TEMPLATE
+            TRUCK_SECRETS_FILEPATH, TRUCK_SECRETS_TEMPLATE
         )
 
         return cls.SECRETS
@@ -337,8 +3042,7 @@ class Truck:
         swift_override = cls.secrets().get("SWIFT_VERSION_OVERRIDE")
         if not swift_override:
             return version
-        regex = re.compile(r"\d+(\.\d+)+-\d+(\.\d+)+-\d+(\.\d+)+$")
-        return regex.sub(swift_override, version)
+        return cls.SWIFT_VERSION_PATTERN.sub(swift_override, version)
 
 ####
 # Truck client implementation
@@ -350,8 +3054,6 @@ class Truck:
 class TruckClient:
 
     def __init__(self):
-        self.truck_config = self.load_client_config()
-        self.deps_on_disk = self.load_deps_on_disk()
         self.actions = [
             TruckAction(
                 "list",
@@ -363,16 +3065,18 @@ class TruckClient:
             TruckAction(
                 "sync",
                 0,
-                "truck sync",
+                "truck sync [--jobs 4]",
                 "downloads deps if neccessary",
-                self.perform_sync_action
+                self.perform_sync_action,
+                options=("jobs",)
             ),
             TruckAction(
                 "pull",
                 0,
-                "truck pull",
+                "truck pull [--jobs 4]",
                 "download all deps regardless of local cache",
-                self.perform_sync_action
+                self.perform_pull_action,
+                options=("jobs",)
             ),
             TruckAction(
                 "check",
@@ -395,6 +3099,21 @@ class TruckClient:
                 "print version and exit",
                 self.perform_version_action
             ),
+            TruckAction(
+                "cache",
+                1,
+                "truck cache stats",
+                "prints download cache stats, or evicts entries over the limit (stats/gc)",
+                self.perform_cache_action
+            ),
+            TruckAction(
+                "serve",
+                0,
+                "truck serve [--port 8744] [--host 0.0.0.0] [--allow github.com,files.example.com]",
+                "serves the download cache to other machines, see MIRROR in ~/.truckrc",
+                self.perform_serve_action,
+                options=("port", "host", "allow")
+            ),
             TruckAction(
                 "nuke_cache",
                 0,
@@ -415,23 +3134,32 @@ class TruckClient:
         if not self.truck_config:
             precondition(msg=f"Cannot find truck.json in local directory!")
 
+    @cached_property
+    def truck_config(self):
+        return self.load_client_config()
+
+    @cached_property
+    def deps_on_disk(self):
+        return self.load_deps_on_disk()
+
     def load_client_config(self):
-        config_filename = "truck.json"
-        if not os.path.isfile(config_filename):
+        if not os.path.isfile(TRUCK_CONFIG_FILENAME):
             return None
 
-        with open(config_filename) as f:
+        with open(TRUCK_CONFIG_FILENAME) as f:
             client_json = json.loads(f.read())
 
-        return ClientConfig(client_json, config_filename)
+        return ClientConfig(client_json, TRUCK_CONFIG_FILENAME)
 
     def load_deps_on_disk(self):
-        if not os.path.isdir(TRUCK_ROOT_DIRECTORY):
-            return []
-        all_files = os.listdir(TRUCK_ROOT_DIRECTORY)
-        ver_files = [fname for fname in all_files if fname.endswith(".version")]
-        target_names = [os.path.splitext(f)[0] for f in ver_files]
-        return [TruckDep(name=n) for n in target_names]
+        return [TruckDep(name=n) for n in TruckState.shared().deps]
+
+    def save_sync_status(self):
+        # fingerprints truck.json, so the next truck check can skip all this
+        if not self.truck_config:
+            return
+        in_sync = not any(dep.is_out_of_sync for dep in self.truck_config.deps)
+        TruckState.shared().update_fingerprint(self.truck_config.filepath, in_sync)
 
     def clean_deps(self, deps, protected_files):
         print("Cleaning:")
@@ -457,32 +3185,333 @@ class TruckClient:
                 continue
             filepath = os.path.join(TRUCK_ROOT_DIRECTORY, f)
             try:
-                if os.path.isfile(filepath):
-                    os.remove(filepath)
-                else:
-                    shutil.rmtree(filepath)
+                self.trash(filepath)
+            except FileNotFoundError:
+                pass
             except:
                 print("warning: failed to remove " + filepath)
 
-        os.remove(dep.version_filepath)
+        # only the dep's own files go from the ones other deps share
+        self.remove_files(dep, protected_files)
+        TruckState.shared().remove(dep.name)
 
     def download_binary_and_spec(self, dep):
-        dep.download_spec()
-        dep.download_binary()
+        # runs on a worker thread, returning the captured output along with
+        # the error (if any) for the main thread to report in order
+        output = sys.stdout
+        buffered = isinstance(output, ThreadOutput)
+        if buffered:
+            output.capture()
+
+        error = None
+        try:
+            if not dep.spec_json:
+                dep.download_spec()
+            try:
+                dep.download_binary()
+            except DownloadError as e:
+                # e.g. by a version released again since it was locked, or
+                # an index whose upload failed after the spec's
+                if not dep.spec_source:
+                    raise
+                print(f"warning: {dep.name} failed to download as resolved from the {dep.spec_source} ({e}), "
+                      "resolving it again")
+                dep.spec_source = None
+                dep.download_spec(False)
+                dep.download_binary()
+        except Exception as e:
+            error = e
 
-    def extract_archive(self, dep):
+        return (output.release() if buffered else ""), error
+
+    def download_index(self, base_url):
+        url = os.path.join(base_url, TRUCK_INDEX_FILENAME)
+        path = os.path.join(TRUCK_TMP_DIRECTORY, f"index-{DownloadCache().key_for_url(url)}.json")
+        try:
+            with Tracer.shared().span("index", url=url):
+                download(url, path, revalidate=True)
+            with open(path) as f:
+                return json.loads(f.read())["targets"]
+        except (DownloadError, ValueError, KeyError) as e:
+            print(f"warning: {url} is unavailable ({e}), fetching specs one by one")
+            return {}
+
+    def resolve_specs(self, deps, use_lock=True):
+        # locked deps need no spec at all. The others, when published to the
+        # same place, get their specs from its index in one request. Anything
+        # the index lacks (or is stale about) falls back to the dep's own spec
+        groups = OrderedDict()
+        for dep in deps:
+            locked = use_lock and TruckLock.shared().get(dep)
+            if locked:
+                dep.spec_json = locked
+                dep.spec_source = "lock"
+                continue
+            groups.setdefault(os.path.dirname(dep.spec_url), []).append(dep)
+
+        for base_url, group in groups.items():
+            if len(group) < 2:
+                continue
+
+            index_json = self.download_index(base_url)
+            for dep in group:
+                spec_json = index_json.get(dep.name)
+                if isinstance(spec_json, dict) and dep.version in spec_json:
+                    dep.spec_json = spec_json
+                    dep.spec_source = "index"
+
+    def build_manifest(self, dep, staged):
+        # adds the mtime every file got on disk to its size and crc, so that
+        # local modifications are caught by later updates
+        root = dep.extraction_path
+        return {
+            name: [size, crc, os.lstat(os.path.join(root, name)).st_mtime_ns]
+            for name, (size, crc) in staged.items()
+        }
+
+    def is_unchanged(self, path, size, crc, entry):
+        if not entry or entry[:2] != [size, crc]:
+            return False
+
+        try:
+            stat = os.lstat(path)
+        except FileNotFoundError:
+            return False
+
+        return stat.st_size == entry[0] and stat.st_mtime_ns == entry[2]
+
+    def extract_archive(self, dep, root):
+        zref = dep.binary_zipfile
+        infos = zref.infolist()
+        zref.close()
+        os.makedirs(root, exist_ok=True)
+        ZipExtractor(dep.binary_path).extract(infos, root)
+        return {info.filename: [info.file_size, info.CRC] for info in infos if not info.is_dir()}
+
+    def update_archive(self, dep, manifest):
+        # stages the files which didn't change since the pinned version was
+        # extracted by linking (or cloning) them, and only extracts the others
+        root = dep.extraction_path
         zref = dep.binary_zipfile
-        zref.extractall(dep.extraction_path)
+        infos = zref.infolist()
         zref.close()
 
+        changed = []
+        for info in infos:
+            path = os.path.join(root, info.filename)
+            if info.is_dir() or not self.is_unchanged(path, info.file_size, info.CRC, manifest.get(info.filename)):
+                changed.append(info)
+                continue
+
+            staged_path = os.path.join(dep.staging_path, info.filename)
+            os.makedirs(os.path.dirname(staged_path), exist_ok=True)
+            if os.path.islink(path):
+                os.symlink(os.readlink(path), staged_path)
+            else:
+                materialize(path, staged_path)
+
+        os.makedirs(dep.staging_path, exist_ok=True)
+        ZipExtractor(dep.binary_path).extract(changed, dep.staging_path)
+        staged = {info.filename: [info.file_size, info.CRC] for info in infos if not info.is_dir()}
+
+        updated = len([info for info in changed if not info.is_dir()])
+        removed = len([name for name in manifest if name not in staged])
+        print(f"{dep.name}: {updated} updated, {removed} removed, {len(staged) - updated} unchanged")
+        return staged
+
+    def compare_staged(self, dep, manifest):
+        # tar archives are staged while downloading, all that's left is
+        # reporting what changed
+        root = dep.extraction_path
+        staged = dep.staged_manifest
+        if manifest:
+            updated = len([
+                name for name, (size, crc) in staged.items()
+                if not self.is_unchanged(os.path.join(root, name), size, crc, manifest.get(name))
+            ])
+            removed = len([name for name in manifest if name not in staged])
+            print(f"{dep.name}: {updated} updated, {removed} removed, {len(staged) - updated} unchanged")
+        return staged
+
     def pin_version(self, dep):
-        with open(dep.version_filepath, "w+") as f:
-            f.write(json.dumps({
-                "version": dep.version,
-                "files": dep.binary_filelist
-            }))
+        TruckState.shared().pin(
+            dep.name, dep.version, dep.binary_filelist, dep.binary_manifest, dep.binary_entry.get("sha256"),
+            TreeStore().link_mode if dep.tree else None
+        )
+
+    def unpin_version(self, dep):
+        TruckState.shared().unpin(dep.name)
+
+    def extract_tree(self, dep, path):
+        if dep.staged_manifest is not None:
+            shutil.move(dep.staging_path, path)
+            return dep.staged_manifest
+        return self.extract_archive(dep, path)
+
+    def stage_tree(self, dep, link_mode):
+        # extracts the archive into the store, unless any checkout already
+        # did, then stages links to its top level files
+        store = TreeStore()
+        sha256 = dep.binary_entry["sha256"]
+        if not dep.tree:
+            dep.tree = store.add(sha256, dep.binary_url, lambda path: self.extract_tree(dep, path))
+
+        os.makedirs(dep.staging_path)
+        store.link(sha256, dep.tree["top_level"], dep.staging_path, link_mode, dep.extraction_path)
+        return dep.tree["files"]
+
+    def trash(self, path):
+        # moves path out of the way with a single rename, for empty_trash to
+        # delete off the critical path
+        import tempfile
+
+        os.makedirs(TRUCK_TRASH_DIRECTORY, exist_ok=True)
+        os.rename(path, os.path.join(tempfile.mkdtemp(dir=TRUCK_TRASH_DIRECTORY), os.path.basename(path)))
+
+    def empty_trash(self):
+        # deletes the trash from a detached process, which carries on after
+        # truck exits. Anything it doesn't get to (e.g. when the machine
+        # shuts down first) is deleted by a later run
+        try:
+            names = os.listdir(TRUCK_TRASH_DIRECTORY)
+        except FileNotFoundError:
+            return
+        if not names:
+            return
+
+        import subprocess
+        subprocess.Popen(
+            ["rm", "-rf", *[os.path.join(TRUCK_TRASH_DIRECTORY, name) for name in names]],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=True
+        )
+
+    def shared_files(self, dep):
+        # the top level files other deps installed too, e.g. a directory
+        # they all add their files to
+        return {
+            name for other, meta in TruckState.shared().deps.items() if other != dep.name for name in meta["files"]
+        }
+
+    def unlink_tree(self, path):
+        # replaces a symlink to a directory in the TreeStore by links to its
+        # files, so that other deps' files can go next to them
+        import tempfile
+
+        unlinked = os.path.join(tempfile.mkdtemp(dir=TRUCK_TMP_DIRECTORY), os.path.basename(path))
+        copy_tree(os.path.realpath(path), unlinked, os.link)
+        os.remove(path)
+        os.rename(unlinked, path)
+
+    def merge(self, src, dst):
+        # moves the staged src into dst, merging directories so that the
+        # files other deps have there are kept
+        if os.path.isdir(src) and os.path.isdir(dst):
+            for path in (src, dst):
+                if os.path.islink(path):
+                    self.unlink_tree(path)
+            for name in os.listdir(src):
+                self.merge(os.path.join(src, name), os.path.join(dst, name))
+            os.rmdir(src)
+            return
+
+        # unchanged files are staged as hardlinks, which renaming over the
+        # file they link to wouldn't remove
+        if os.path.lexists(dst) and os.path.samestat(os.lstat(src), os.lstat(dst)):
+            os.remove(src)
+            return
+        # renaming replaces files in a single step, but not directories
+        if os.path.lexists(dst) and (os.path.isdir(src) or (os.path.isdir(dst) and not os.path.islink(dst))):
+            self.trash(dst)
+        os.rename(src, dst)
+
+    def remove_files(self, dep, names, keep=()):
+        # deletes the files the pinned version had under names (shared
+        # with other deps) but keep doesn't, along with emptied directories
+        root = dep.extraction_path
+        for name in dep.old_manifest or {}:
+            if name.split("/")[0] not in names or name in keep:
+                continue
+
+            path = os.path.join(root, name)
+            if os.path.lexists(path) and not os.path.isdir(path):
+                os.remove(path)
+            parent = os.path.dirname(path)
+            while parent != root:
+                try:
+                    os.rmdir(parent)
+                except OSError:
+                    break
+                parent = os.path.dirname(parent)
+
+    def swap_in(self, dep, staged):
+        # renames the staged top level files into place, trashing what they
+        # replace along with what the pinned version had but this one
+        # doesn't. A file is only ever missing for the duration of a rename.
+        # Top level directories other deps installed files to are merged
+        # into instead, file by file
+        root = dep.extraction_path
+        names = os.listdir(dep.staging_path)
+        shared = self.shared_files(dep)
+        for name in dep.old_spec["files"] if dep.old_spec else []:
+            if name not in names and name not in shared and os.path.lexists(os.path.join(root, name)):
+                self.trash(os.path.join(root, name))
+
+        for name in names:
+            path = os.path.join(root, name)
+            if name in shared and os.path.lexists(path):
+                self.merge(os.path.join(dep.staging_path, name), path)
+                continue
+            if os.path.lexists(path):
+                self.trash(path)
+            os.rename(os.path.join(dep.staging_path, name), path)
+
+        self.remove_files(dep, shared, staged)
+        os.rmdir(dep.staging_path)
+        dep.binary_filelist = names
+
+    def install_dep(self, dep):
+        # every version is staged in Truck/Tmp, then swapped in. Updates reuse
+        # the files which didn't change, except for deps pinned by older
+        # trucks, which have no manifest, and deps linked to the TreeStore (or
+        # about to be), whose files belong to the store
+        tracer = Tracer.shared()
+        link_mode = dep.binary_entry.get("sha256") and TreeStore().link_mode
+        manifest = dep.old_spec and dep.old_manifest
+        if link_mode or (dep.old_spec and dep.old_spec.get("tree")):
+            manifest = None
+        # an interrupted update leaves the dep unpinned, along with whatever
+        # files the next one needs to trash
+        if dep.old_spec:
+            self.unpin_version(dep)
+
+        if link_mode:
+            phase, stage = "link", lambda: self.stage_tree(dep, link_mode)
+        elif dep.staged_manifest is not None:
+            phase, stage = "staged", lambda: self.compare_staged(dep, manifest)
+        elif manifest is None:
+            phase, stage = "extract", lambda: self.extract_archive(dep, dep.staging_path)
+        else:
+            phase, stage = "update", lambda: self.update_archive(dep, manifest)
+
+        with tracer.span(phase, dep=dep.name) as span:
+            staged = stage()
+            span["files"] = len(staged)
+
+        with tracer.span("swap", dep=dep.name):
+            self.swap_in(dep, staged)
+        dep.binary_manifest = staged if dep.tree else self.build_manifest(dep, staged)
+
+        with tracer.span("pin_version", dep=dep.name):
+            self.pin_version(dep)
 
-    def fetch_deps(self, deps):
+    def fetch_deps(self, deps, jobs=None, use_lock=True):
+
+        jobs = str(jobs or DEFAULT_SYNC_JOBS)
+        precondition(jobs.isdigit() and int(jobs) > 0, "--jobs expects a positive number")
+        jobs = int(jobs)
 
         if not deps:
             print("All deps are up to date!")
@@ -492,33 +3521,77 @@ class TruckClient:
         print("\n".join([str(dep) for dep in deps]))
 
         self.clean_temp_folder()
+        # keep enough idle connections around for every worker
+        transport = HttpTransport.shared()
+        transport.pool_size = max(transport.pool_size, jobs)
+        self.resolve_specs(deps, use_lock)
+
+        # a single job keeps the original sequential flow (and progress bar),
+        # otherwise downloads run ahead on a pool while the main thread
+        # installs them in truck.json order, keeping the output deterministic
+        stdout = sys.stdout
+        executor = None
+        if jobs > 1:
+            from concurrent.futures import ThreadPoolExecutor
+            sys.stdout = ThreadOutput(stdout)
+            executor = ThreadPoolExecutor(max_workers=jobs)
+            downloads = executor.map(self.download_binary_and_spec, deps)
+        else:
+            downloads = map(self.download_binary_and_spec, deps)
 
-        for dep in deps:
-            self.download_binary_and_spec(dep)
-            self.clean_extraction_path(dep)
-            self.extract_archive(dep)
-            self.pin_version(dep)
-            print(dep.name + " synced!")
-
+        failures = []
+        try:
+            for dep, (output, error) in zip(deps, downloads):
+                stdout.write(output)
+                if not error:
+                    try:
+                        self.install_dep(dep)
+                    except Exception as e:
+                        error = e
+
+                if error:
+                    print(f"error: {dep.name} failed to sync")
+                    failures.append((dep, error))
+                else:
+                    TruckLock.shared().lock(dep)
+                    print(dep.name + " synced!")
+        finally:
+            sys.stdout = stdout
+            if executor:
+                executor.shutdown()
+
+        self.empty_trash()
         self.clean_temp_folder()
+        TruckLock.shared().save(self.truck_config.deps)
+        self.save_sync_status()
+
+        if failures:
+            print("Failed to sync:")
+            print("\n".join([f"{dep} - {e!r}" for dep, e in failures]))
+            exit(1)
 
     def perform_list_action(self):
         self.assert_truck_config_available()
         print("\n".join([str(dep) for dep in sorted(self.deps_on_disk, key=lambda x: x.name)]))
 
-    def perform_sync_action(self):
+    def perform_sync_action(self, jobs=None):
         self.assert_truck_config_available()
         deps = [dep for dep in self.truck_config.deps if dep.is_out_of_sync]
-        self.fetch_deps(deps)
+        self.fetch_deps(deps, jobs)
 
-    def perform_pull_action(self):
+    def perform_pull_action(self, jobs=None):
+        # resolves every dep again, refreshing truck.lock
         self.assert_truck_config_available()
-        self.fetch_deps(self.truck_config.deps)
+        self.fetch_deps(self.truck_config.deps, jobs, use_lock=False)
 
     def perform_check_action(self):
-        self.assert_truck_config_available()
-        deps = [dep for dep in self.truck_config.deps if dep.is_out_of_sync]
-        print("error" if deps else "ok")
+        in_sync = TruckState.cached_check(TRUCK_CONFIG_FILENAME)
+        if in_sync is None:
+            self.assert_truck_config_available()
+            in_sync = not any(dep.is_out_of_sync for dep in self.truck_config.deps)
+            self.save_sync_status()
+
+        print("ok" if in_sync else "error")
 
     def perform_clean_action(self, target):
         self.assert_truck_config_available()
@@ -533,17 +3606,76 @@ class TruckClient:
         elif target != "all":
             deps = [d for d in deps if d.name.lower() == target.lower()]
         self.clean_deps(deps, protected_files)
+        self.empty_trash()
+        self.save_sync_status()
 
     def perform_version_action(self):
         print(TRUCK_VERSION)
 
+    def perform_cache_action(self, command):
+        cache = DownloadCache()
+        if command == "stats":
+            cache.stats()
+            TreeStore().stats()
+        elif command == "gc":
+            cache.gc()
+            TreeStore().gc()
+        else:
+            precondition(msg=f"Unknown cache command: {command} (expected stats or gc)")
+
+    def perform_serve_action(self, port=None, host=None, allow=None):
+        from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+        port = str(port or MIRROR_PORT)
+        precondition(port.isdigit(), "--port expects a number")
+        host = host or "127.0.0.1"
+        mirror = CacheMirror([h.strip() for h in (allow or MIRROR_ALLOWED_HOSTS).split(",") if h.strip()])
+
+        class MirrorRequestHandler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                mirror.handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, int(port)), MirrorRequestHandler)
+        print(f"Serving {mirror.cache.cache_dir} on {host}:{port}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+
     def perform_nuke_cache_action(self):
         cache = DownloadCache()
         cache.nuke()
+        TreeStore().nuke()
 
     def perform_set_version_action(self, target, new_version):
+        self.assert_truck_config_available()
         self.truck_config.set_target_version(target, new_version)
 
+        # resolves the new version right away, so the next sync (on any
+        # machine sharing truck.lock) has nothing to look up
+        lock = TruckLock.shared()
+        for dep in self.truck_config.deps:
+            if dep.name != target:
+                continue
+            dep.version = Truck.process_version(dep.raw_version)
+            self.clean_temp_folder()
+            try:
+                dep.download_spec()
+                lock.lock(dep)
+            except Exception as e:
+                print(f"warning: couldn't resolve {dep} ({e!r}), sync will")
+                lock.unlock(dep.name)
+            self.clean_temp_folder()
+
+        lock.save(self.truck_config.deps)
+
 
 ####
 # TruckAuthor
@@ -560,6 +3692,8 @@ class Hosting:
 
         if "github" in self.config:
             self.hosts.append(GithubHost(config))
+        for mirror_config in self.config.get("mirrors", []):
+            self.hosts.append(MirrorHost(mirror_config))
 
     @property
     def active_hosting(self):
@@ -568,29 +3702,89 @@ class Hosting:
             precondition("Please populate truck-author.json with a supported host")
         return hosts[0]
 
+    @property
+    def mirrors(self):
+        return self.all()[1:]
+
     def all(self):
         return self.hosts
 
+    def fetch_json(self, uri_for_host):
+        # fetches a file from every host at once. Hosts which don't have it
+        # (yet) are fine, anything else is reported
+        from concurrent.futures import ThreadPoolExecutor
+        from urllib.error import HTTPError
+
+        def fetch(host):
+            url = uri_for_host(host)
+            try:
+                return json.loads(simple_download(url))
+            except HTTPError as e:
+                # S3 answers 403 for missing keys, unless allowed to list them
+                if e.code not in (403, 404):
+                    print(f"warning: failed to fetch {url} ({e})")
+            except Exception as e:
+                print(f"warning: failed to fetch {url} ({e})")
+            return {}
+
+        hosts = self.all()
+        with ThreadPoolExecutor(max_workers=max(1, len(hosts))) as executor:
+            return list(executor.map(fetch, hosts))
+
     def find_spec(self, target):
+        # merged, with the main host taking precedence over the mirrors
         spec = {}
-        for host in self.all():
-            try:
-                json_http_uri = host.spec_http_uri(target)
-                spec_data = simple_download(json_http_uri)
-                spec.update(json.loads(spec_data))
-            except:
-                pass
+        for host_spec in reversed(self.fetch_json(lambda host: host.spec_http_uri(target))):
+            spec.update(host_spec)
 
         return spec
 
-class GithubHost:
-    def __init__(self, config):
-        self.user = config["github"]["user"]
-        self.repo = config["github"]["repo"]
-        self.base_path = "https://github.com/{user}/{repo}/releases/download/truck".format(
-            user=self.user,
-            repo=self.repo
-        )
+    def find_index(self):
+        index = {"targets": {}}
+        for host_index in reversed(self.fetch_json(lambda host: host.index_http_uri())):
+            index["targets"].update(host_index.get("targets", {}))
+
+        return index
+
+    def publish(self, *args):
+        # the mirrors go first, so the main host's spec never points clients
+        # at mirrors missing the files
+        for host in self.mirrors + [self.active_hosting]:
+            host.publish(*args)
+
+class UploadReader:
+    # file-like view over an asset being uploaded, reporting the progress of
+    # every concurrent upload on a single line
+
+    def __init__(self, file, progress):
+        self.file = file
+        self.progress = progress
+        self.size = 0
+
+    def read(self, n=-1):
+        data = self.file.read(n)
+        self.size += len(data)
+        self.progress.update(len(data))
+        return data
+
+
+class UploadProgress:
+
+    def __init__(self, total_size):
+        self.lock = threading.Lock()
+        self.size = 0
+        self.total_size = total_size
+        self.start_time = time.time()
+
+    def update(self, size):
+        with self.lock:
+            self.size += size
+            reporthook(self.size, self.total_size, self.start_time)
+
+
+class Host:
+    # where releases are published. Subclasses set base_path, the url their
+    # files are downloaded from, and implement upload_files
 
     # path definitions
 
@@ -603,28 +3797,185 @@ class GithubHost:
         spec_path = "{t}.json".format(t=target)
         return self.build_http_uri(spec_path)
 
+    ## index uris
+    def index_http_uri(self):
+        return self.build_http_uri(TRUCK_INDEX_FILENAME)
+
     ## binary uris
-    def binary_http_uri(self, target, version):
-        binary_path = "{t}-{v}.zip".format(t=target, v=version)
-        return self.build_http_uri(binary_path)
+    def binary_name(self, target, version, archive_format="zip"):
+        return "{t}-{v}.{f}".format(t=target, v=version, f=archive_format)
+
+    def binary_http_uri(self, target, version, archive_format="zip"):
+        return self.build_http_uri(self.binary_name(target, version, archive_format))
+
+    ## delta uris
+    def delta_name(self, target, base_version, version):
+        return "{t}-{b}-to-{v}.delta".format(t=target, b=base_version, v=version)
+
+    def delta_http_uri(self, target, base_version, version):
+        return self.build_http_uri(self.delta_name(target, base_version, version))
+
+    # actions
+
+    def publish(self, target, version, spec_filepath, archive_filepath, extra_files=(), index_filepath=None):
+        # the spec goes last, so it never points clients at missing assets
+        if archive_filepath:
+            binary_name = self.binary_name(target, version, archive_format(archive_filepath))
+            self.upload_files([(binary_name, archive_filepath), *extra_files])
+
+        spec_name = f'{target}.json'
+        self.upload_files([(spec_name, spec_filepath)])
+
+        if index_filepath:
+            self.upload_files([(TRUCK_INDEX_FILENAME, index_filepath)])
+
+
+class GithubHost(Host):
+    def __init__(self, config):
+        self.user = config["github"]["user"]
+        self.repo = config["github"]["repo"]
+        self.base_path = "https://github.com/{user}/{repo}/releases/download/{tag}".format(
+            user=self.user,
+            repo=self.repo,
+            tag=GITHUB_RELEASE_TAG
+        )
+        # "api_url" and "download_url" point truck at GitHub Enterprise (or a
+        # mock server), "uploader": "github-release" falls back to the cli
+        self.base_path = config["github"].get("download_url", self.base_path).rstrip("/")
+        self.api_url = config["github"].get("api_url", GITHUB_API_URL).rstrip("/")
+        self.uploader = config["github"].get("uploader", "native")
+        self.release = None
+
+    # path definitions
+
+    ## api uris
+    def repo_api_uri(self, path):
+        return f"{self.api_url}/repos/{self.user}/{self.repo}/{path}"
 
     # actions
 
+    def api_request(self, url, method="GET", body=None, headers=None):
+        headers = {
+            "Accept": "application/vnd.github+json",
+            "Authorization": "token " + Truck.secrets()["GITHUB_TOKEN"],
+            **(headers or {})
+        }
+        if isinstance(body, dict):
+            body = json.dumps(body).encode()
+            headers["Content-Type"] = "application/json"
+
+        with HttpTransport.shared().request(url, headers, method, body) as response:
+            data = response.read()
+        return json.loads(data) if data else None
+
+    def find_or_create_release(self):
+        from urllib.error import HTTPError
+
+        if self.release:
+            return self.release
+
+        try:
+            self.release = self.api_request(self.repo_api_uri(f"releases/tags/{GITHUB_RELEASE_TAG}"))
+        except HTTPError as e:
+            if e.code != 404:
+                raise
+            body = {"tag_name": GITHUB_RELEASE_TAG, "name": GITHUB_RELEASE_TAG}
+            self.release = self.api_request(self.repo_api_uri("releases"), "POST", body)
+
+        return self.release
+
+    def list_assets(self, release):
+        assets = []
+        for page in range(1, 100):
+            batch = self.api_request(self.repo_api_uri(f"releases/{release['id']}/assets?per_page=100&page={page}"))
+            assets += batch
+            if len(batch) < 100:
+                break
+        return assets
+
+    def spec_targets(self):
+        # the targets with a spec published on the release
+        names = [asset["name"] for asset in self.list_assets(self.find_or_create_release())]
+        return sorted(os.path.splitext(n)[0] for n in names if n.endswith(".json") and n != TRUCK_INDEX_FILENAME)
+
+    def upload_asset(self, release, name, local_path, progress):
+        # replaces any asset by the same name, including the broken ones
+        # failed uploads leave behind, then streams the file from disk
+        from urllib.parse import quote
+
+        for asset in self.list_assets(release):
+            if asset["name"] == name:
+                self.api_request(self.repo_api_uri(f"releases/assets/{asset['id']}"), "DELETE")
+
+        upload_url = release["upload_url"].split("{")[0] + "?name=" + quote(name)
+        headers = {
+            "Content-Type": "application/json" if name.endswith(".json") else "application/octet-stream",
+            "Content-Length": str(os.path.getsize(local_path))
+        }
+        with open(local_path, "rb") as f, Tracer.shared().span("upload", asset=name, bytes=int(headers["Content-Length"])):
+            reader = UploadReader(f, progress)
+            try:
+                self.api_request(upload_url, "POST", reader, headers)
+            except:
+                # takes back what was sent, ahead of a retry
+                progress.update(-reader.size)
+                raise
+
+    def upload_asset_with_retries(self, release, name, local_path, progress):
+        for attempt in range(DOWNLOAD_RETRIES):
+            try:
+                return self.upload_asset(release, name, local_path, progress)
+            except Exception as e:
+                if attempt == DOWNLOAD_RETRIES - 1 or not is_retryable(e):
+                    raise DownloadError(f"{name} failed to upload: {e}") from e
+
+                delay = DOWNLOAD_BACKOFF * 2 ** attempt
+                print(f"warning: {name} failed to upload ({e}), retrying in {delay}s")
+                time.sleep(delay)
+
+    def upload_files(self, files):
+        # uploads (name, local_path) pairs concurrently, over pooled connections
+        from concurrent.futures import ThreadPoolExecutor
+
+        if self.uploader == "github-release":
+            for name, local_path in files:
+                self.upload_file(name, local_path)
+            return
+
+        try:
+            release = self.find_or_create_release()
+            progress = UploadProgress(sum(os.path.getsize(path) for _, path in files))
+            with ThreadPoolExecutor(max_workers=len(files)) as executor:
+                futures = [
+                    executor.submit(self.upload_asset_with_retries, release, name, local_path, progress)
+                    for name, local_path in files
+                ]
+                for future in futures:
+                    future.result()
+        except Exception as e:
+            sys.stdout.write('\x1b[2K\r')
+            print(f"Failed to upload to Github: {e}")
+            exit(1)
+
+        sys.stdout.write('\x1b[2K\r')
+        for name, _ in files:
+            print("... Uploaded " + name)
+
     def upload_file(self, name, local_path):
 
-        upload_command = " ".join(map(lambda i: "=".join(i), Truck.secrets().items()))
+        upload_command = " ".join([f"{k}={v}" for k, v in Truck.secrets().items()])
         upload_command += (
             ' github-release upload --replace'
             ' -u {user}'
             ' -r {repo}'
-            ' -t truck'
+            ' -t {tag}'
             ' -n {name}'
             ' -f {file}'
-        ).format(user=self.user, repo=self.repo, name=name, file=local_path)
+        ).format(user=self.user, repo=self.repo, tag=GITHUB_RELEASE_TAG, name=name, file=local_path)
 
         os.system(upload_command)
 
-    def publish(self, target, version, spec_filepath, archive_filepath):
+    def publish(self, target, version, spec_filepath, archive_filepath, extra_files=(), index_filepath=None):
         # TODO - possibly fallback to env to find the keys
         if "GITHUB_TOKEN" not in Truck.secrets():
             print("Could not find Github token in config nor env")
@@ -632,19 +3983,76 @@ class GithubHost:
             exit(1)
 
         print("Uploading to Github ...")
+        super().publish(target, version, spec_filepath, archive_filepath, extra_files, index_filepath)
 
-        spec_name = f'{target}.json'
-        self.upload_file(spec_name, spec_filepath)
 
-        if archive_filepath:
-            binary_name = f'{target}-{version}.zip'
-            self.upload_file(binary_name, archive_filepath)
+class MirrorHost(Host):
+    # another place releases are published to, listed under "mirrors" in
+    # truck-author.json. Files are uploaded to an S3 bucket with the aws cli
+    # when "s3" is set (e.g. "s3://bucket/truck"), otherwise PUT to
+    # "upload_url" (defaulting to "url") along with any "headers". Either
+    # way, clients download them from "url"
+
+    def __init__(self, config):
+        self.base_path = config["url"].rstrip("/")
+        self.s3_path = config.get("s3", "").rstrip("/")
+        self.endpoint_url = config.get("endpoint_url")
+        self.upload_url = config.get("upload_url", self.base_path).rstrip("/")
+        self.headers = config.get("headers", {})
+
+    def s3_upload(self, name, local_path):
+        import subprocess
+
+        command = ["aws", "s3", "cp", local_path, f"{self.s3_path}/{name}", "--only-show-errors"]
+        if self.endpoint_url:
+            command += ["--endpoint-url", self.endpoint_url]
+        # specs and indexes change in place, so caches in front of the
+        # bucket should always revalidate them
+        if name.endswith(".json"):
+            command += ["--content-type", "application/json", "--cache-control", "no-cache"]
+        if subprocess.run(command).returncode:
+            raise DownloadError(f"aws s3 cp {name} failed")
+
+    def put(self, name, local_path):
+        headers = {
+            **self.headers,
+            "Content-Type": "application/json" if name.endswith(".json") else "application/octet-stream",
+            "Content-Length": str(os.path.getsize(local_path))
+        }
+        with open(local_path, "rb") as f, Tracer.shared().span("upload", asset=name, bytes=int(headers["Content-Length"])):
+            with HttpTransport.shared().request(f"{self.upload_url}/{name}", headers, "PUT", f) as response:
+                response.read()
+
+    def upload_files(self, files):
+        if self.s3_path:
+            precondition(shutil.which("aws"), "Uploading to S3 requires the aws cli (brew install awscli)")
+
+        for name, local_path in files:
+            for attempt in range(DOWNLOAD_RETRIES):
+                try:
+                    if self.s3_path:
+                        self.s3_upload(name, local_path)
+                    else:
+                        self.put(name, local_path)
+                    break
+                except Exception as e:
+                    if attempt == DOWNLOAD_RETRIES - 1 or not is_retryable(e):
+                        print(f"Failed to upload {name} to {self.base_path}: {e}")
+                        exit(1)
+
+                    delay = DOWNLOAD_BACKOFF * 2 ** attempt
+                    print(f"warning: {name} failed to upload ({e}), retrying in {delay}s")
+                    time.sleep(delay)
+
+            print(f"... Uploaded {name} to {self.base_path}")
+
+    def publish(self, target, version, spec_filepath, archive_filepath, extra_files=(), index_filepath=None):
+        print(f"Uploading to {self.base_path} ...")
+        super().publish(target, version, spec_filepath, archive_filepath, extra_files, index_filepath)
 
 
 class TruckAuthor:
     def __init__(self):
-        self.config = self.load_author_config()
-        self.hosting = Hosting(self.config)
         self.actions = [
             TruckAction(
                 "init",
@@ -663,9 +4071,18 @@ class TruckAuthor:
             TruckAction(
                 "release",
                 range(1, 3),
-                "truck release zendesk-sdk [3.0.2]",
+                "truck release zendesk-sdk [3.0.2] [--jobs 8]",
                 "packages then uploads a release for given target",
-                self.perform_release_action
+                self.perform_release_action,
+                options=("jobs",)
+            ),
+            TruckAction(
+                "bench-pack",
+                1,
+                "truck bench-pack zendesk-sdk [--jobs 8]",
+                "compares pack time, size and extract time of compression settings for given target",
+                self.perform_bench_pack_action,
+                options=("jobs",)
             ),
             TruckAction(
                 "versions",
@@ -687,9 +4104,25 @@ class TruckAuthor:
                 "truck rmversion zendesk-sdk 1.1.0",
                 "removes the specified version from remote",
                 self.perform_rmversion_action
+            ),
+            TruckAction(
+                "reindex",
+                0,
+                "truck reindex",
+                "rebuilds the index of all the targets published on the host",
+                self.perform_reindex_action
             )
         ]
 
+    # truck-author.json is only read by the author actions that need it
+    @cached_property
+    def config(self):
+        return self.load_author_config()
+
+    @cached_property
+    def hosting(self):
+        return Hosting(self.config)
+
     def load_author_config(self):
         config_filename = "truck-author.json"
         if not os.path.isfile(config_filename):
@@ -702,15 +4135,17 @@ class TruckAuthor:
 
     def assert_truck_config_available(self):
         if not self.config:
-            print("Cannot find {} in local directory!".format(config_filename))
+            print("Cannot find truck-author.json in local directory!")
             print("Try running from correct dir, or run truck init")
             exit(1)
 
 
-    def infer_target_version(self, spec_json):
+    def sorted_versions(self, spec_json):
+        from distutils.version import LooseVersion
+        return sorted(spec_json.keys(), key=lambda x: LooseVersion(x))
 
-        versions = spec_json.keys()
-        versions = sorted(versions, key=lambda x: LooseVersion(x))
+    def infer_target_version(self, spec_json):
+        versions = self.sorted_versions(spec_json)
 
         if not versions:
             return "1.0.0"
@@ -720,23 +4155,77 @@ class TruckAuthor:
         split_version[-1] = str(int(split_version[-1]) + 1)
         return ".".join(split_version)
 
-    def prepare_staging_area(self, root_dir, files):
+    def prepare_staging_area(self, root_dir):
 
         try:
             shutil.rmtree(root_dir)
         except:
             pass
 
-        files_dir = os.path.join(root_dir, "files")
-        os.makedirs(files_dir)
+        os.makedirs(root_dir)
+
+    def pack_settings(self, config_json):
+        # the validated archive format and compression of a target config
+        archive_format = config_json.get("format", "zip")
+        if archive_format not in ARCHIVE_FORMATS:
+            print(f"Unsupported format: {archive_format}")
+            print("Please use one of: " + ", ".join(ARCHIVE_FORMATS))
+            exit(1)
+
+        methods = COMPRESSION_METHODS[archive_format]
+        compression = config_json.get("compression", methods[0])
+        if compression not in methods:
+            print(f"Unsupported compression for {archive_format}: {compression}")
+            print("Please use one of: " + ", ".join(methods))
+            exit(1)
+
+        level = config_json.get("level")
+        levels = COMPRESSION_LEVELS.get(compression, [])
+        if level is not None and level not in levels:
+            if levels:
+                print(f"{compression} levels range from {levels[0]} to {levels[-1]}")
+            else:
+                print(f"{compression} doesn't support levels")
+            exit(1)
 
+        return {
+            "format": archive_format,
+            "compression": compression,
+            "level": level,
+            "store_incompressible": config_json.get("store_incompressible", True)
+        }
+
+    def make_archive(self, staging_dir, target, files, settings, jobs):
+        # archives the configured files in place, under their basenames
+        import gzip
+        import tarfile
+
+        archive_format = settings["format"]
+        level = settings["level"]
+        archive_filepath = os.path.join(staging_dir, f"{target}.{archive_format}")
+        files = [f.rstrip("/") for f in files]
         for f in files:
-            if os.path.isdir(f):
-                shutil.copytree(f, os.path.join(files_dir, os.path.basename(f)))
+            precondition(os.path.exists(f), f"{f} doesn't exist!")
+
+        if archive_format == "zip":
+            packager = ZipPackager(jobs, settings["compression"], level, settings["store_incompressible"])
+            packager.write(archive_filepath, files)
+            return archive_filepath
+
+        # tar archives are written with plain member names (no ./ prefix)
+        with open(archive_filepath, "wb") as f:
+            if archive_format == "tar.zst":
+                compressor = import_zstandard().ZstdCompressor(level=level or 3, threads=jobs or -1)
+                stream = compressor.stream_writer(f)
             else:
-                shutil.copyfile(f, os.path.join(files_dir, os.path.basename(f)))
+                stream = gzip.GzipFile(fileobj=f, mode="wb", compresslevel=9 if level is None else level)
 
-        return files_dir
+            with tarfile.open(fileobj=stream, mode="w|", dereference=True) as tar:
+                for path in sorted(files, key=os.path.basename):
+                    tar.add(path, arcname=os.path.basename(path))
+            stream.close()
+
+        return archive_filepath
 
     def perform_reset_action(self, target):
         self.assert_truck_config_available()
@@ -797,21 +4286,51 @@ class TruckAuthor:
             exit(1)
 
         # TODO: duplicate code, consolidate me please
-        files_dir = self.prepare_staging_area(TRUCK_TMP_DIRECTORY, [])
+        self.prepare_staging_area(TRUCK_TMP_DIRECTORY)
         # write spec to temp file so we can upload it
         spec_filename = TRUCK_SPEC_FILENAME.format(target=target)
         spec_filepath = os.path.join(TRUCK_TMP_DIRECTORY, spec_filename)
         PathUtils.write_json_file(spec_filepath, spec_json)
 
-        host = self.hosting.active_hosting
-        host.publish(target, version, spec_filepath, None)
+        index_filepath = self.write_index(target, spec_json)
+        self.hosting.publish(target, version, spec_filepath, None, (), index_filepath)
         print(f"{target} -> {version} should be removed!")
 
+    def write_index(self, target, spec_json):
+        # index.json carries the spec of every target on the host, so that
+        # clients depending on several of them fetch a single file
+        index_json = self.hosting.find_index()
+        if spec_json:
+            index_json["targets"][target] = spec_json
+        else:
+            index_json["targets"].pop(target, None)
 
-    def perform_release_action(self, target, version=None):
+        index_filepath = os.path.join(TRUCK_TMP_DIRECTORY, TRUCK_INDEX_FILENAME)
+        PathUtils.write_json_file(index_filepath, index_json)
+        return index_filepath
+
+    def perform_reindex_action(self):
+        # for hosts published to by older trucks, or an index which lost an
+        # update to a concurrent release
         self.assert_truck_config_available()
+        host = self.hosting.active_hosting
+        precondition(isinstance(host, GithubHost), "reindex lists the published specs using the Github API")
+        self.prepare_staging_area(TRUCK_TMP_DIRECTORY)
 
-        # load the target config file
+        index_json = {"targets": {}}
+        for target in host.spec_targets():
+            spec_json = self.hosting.find_spec(target)
+            if spec_json:
+                index_json["targets"][target] = spec_json
+
+        index_filepath = os.path.join(TRUCK_TMP_DIRECTORY, TRUCK_INDEX_FILENAME)
+        PathUtils.write_json_file(index_filepath, index_json)
+        for host in self.hosting.all():
+            host.upload_files([(TRUCK_INDEX_FILENAME, index_filepath)])
+        print(f"Indexed {len(index_json['targets'])} targets")
+
+
+    def load_target_config(self, target):
         target_config_filepath = TARGET_CONFIG_FILEPATH.format(target=target)
         if not os.path.isfile(target_config_filepath):
             print(f"Can't find: {target_config_filepath}")
@@ -819,33 +4338,183 @@ class TruckAuthor:
             exit(1)
 
         with open(target_config_filepath) as f:
-            config_json = json.loads(f.read())
+            return json.loads(f.read())
+
+    def perform_bench_pack_action(self, target, jobs=None):
+        # packs the target with every supported setting, then extracts each
+        # archive the way clients do
+        import zipfile
+
+        self.assert_truck_config_available()
+        precondition(jobs is None or (jobs.isdigit() and int(jobs) > 0), "--jobs expects a positive number")
+        jobs = jobs and int(jobs)
+
+        config_json = self.load_target_config(target)
+        configured = self.pack_settings(config_json)
+        all_settings = [{
+            "format": archive_format,
+            "compression": compression,
+            "level": level,
+            "store_incompressible": configured["store_incompressible"]
+        } for archive_format, compression, level in BENCH_PACK_SETTINGS]
+        if configured not in all_settings:
+            all_settings.insert(0, configured)
+
+        files = [f.rstrip("/") for f in config_json["files"]]
+        total_size = sum(os.path.getsize(path) for path, _ in ZipPackager.members(files) if os.path.isfile(path))
+
+        bench_dir = os.path.join(TRUCK_TMP_DIRECTORY, "bench")
+        root = os.path.join(bench_dir, "extracted")
+        self.prepare_staging_area(bench_dir)
+
+        print(f"{target}: {format_size(total_size)} (* configured)")
+        print(f"  {'setting':<20} {'pack':>8} {'size':>10} {'ratio':>6} {'extract':>8}")
+        try:
+            for settings in all_settings:
+                label = f"{settings['format']} {settings['compression']}"
+                if settings["level"] is not None:
+                    label += f" -{settings['level']}"
+                mark = "*" if settings == configured else " "
+
+                if settings["format"] == "tar.zst":
+                    try:
+                        import_zstandard()
+                    except ImportError:
+                        print(f"{mark} {label:<20} skipped, requires zstandard")
+                        continue
+
+                start = time.perf_counter()
+                archive_filepath = self.make_archive(bench_dir, target, files, settings, jobs)
+                pack_time = time.perf_counter() - start
+                size = os.path.getsize(archive_filepath)
+
+                start = time.perf_counter()
+                if settings["format"] == "zip":
+                    with zipfile.ZipFile(archive_filepath) as zref:
+                        ZipExtractor(archive_filepath).extract(zref.infolist(), root)
+                else:
+                    with open(archive_filepath, "rb") as f:
+                        TarExtractor(settings["format"]).extract(f, root)
+                extract_time = time.perf_counter() - start
+
+                ratio = size / total_size if total_size else 1
+                print(f"{mark} {label:<20} {pack_time:7.2f}s {format_size(size):>10} {ratio:6.1%} {extract_time:7.2f}s")
+                shutil.rmtree(root)
+                os.remove(archive_filepath)
+        finally:
+            shutil.rmtree(bench_dir, ignore_errors=True)
+
+    def make_deltas(self, staging_dir, host, target, version, spec_json, archive_filepath, count):
+        # deltas to the new archive from the latest count versions, keyed by
+        # version, along with the (name, path) of the files to upload
+        deltas = OrderedDict()
+        files = []
+        archive_size = os.path.getsize(archive_filepath)
+        versions = [v for v in self.sorted_versions(spec_json) if v != version]
+        for base in versions[-count:]:
+            entry = spec_json[base]
+            entry = {"url": entry} if isinstance(entry, str) else entry
+            if archive_format(entry["url"]) != "zip":
+                continue
+
+            base_path = os.path.join(staging_dir, os.path.basename(entry["url"]))
+            try:
+                download(
+                    entry["url"], base_path, sha256=entry.get("sha256"), size=entry.get("size"),
+                    mirrors=entry.get("mirrors", ())
+                )
+            except DownloadError as e:
+                print(f"warning: skipping the delta from {base} ({e})")
+                continue
+
+            name = host.delta_name(target, base, version)
+            delta_filepath = os.path.join(staging_dir, name)
+            size = ArchiveDelta.create(base_path, archive_filepath, delta_filepath)
+            os.remove(base_path)
+            if size > DELTA_MAX_RATIO * archive_size:
+                print(f"Skipping the delta from {base}, it's {format_size(size)}")
+                os.remove(delta_filepath)
+                continue
+
+            print(f"Created {delta_filepath} ({format_size(size)})")
+            sha256, size = PathUtils.file_digest(delta_filepath)
+            deltas[base] = OrderedDict({
+                "url": host.delta_http_uri(target, base, version),
+                "sha256": sha256,
+                "size": size
+            })
+            if self.hosting.mirrors:
+                deltas[base]["mirrors"] = [m.delta_http_uri(target, base, version) for m in self.hosting.mirrors]
+            files.append((name, delta_filepath))
+
+        return deltas, files
+
+    def perform_release_action(self, target, version=None, jobs=None):
+        self.assert_truck_config_available()
+        precondition(jobs is None or (jobs.isdigit() and int(jobs) > 0), "--jobs expects a positive number")
+        jobs = jobs and int(jobs)
+
+        config_json = self.load_target_config(target)
 
-        # prepare staging area
+        # prepare staging area, which only holds the archive and spec
         staging_dir = TRUCK_TMP_DIRECTORY
-        files_dir = self.prepare_staging_area(staging_dir, config_json["files"])
+        self.prepare_staging_area(staging_dir)
 
-        # add new version to spec json
+        settings = self.pack_settings(config_json)
+        release_format = settings["format"]
+        delta_count = config_json.get("deltas", 0)
+        if not isinstance(delta_count, int) or delta_count < 0:
+            print("deltas should be the number of previous versions to publish deltas from")
+            exit(1)
+
+        tracer = Tracer.shared()
+        with tracer.span("pack", target=target, **settings) as span:
+            archive_filepath = self.make_archive(staging_dir, target, config_json["files"], settings, jobs)
+            span["bytes"] = os.path.getsize(archive_filepath)
+
+        print("Created {}".format(archive_filepath))
+
+        # add new version to spec json, along with the archive's digest so
+        # clients can verify and deduplicate their downloads
         host = self.hosting.active_hosting
 
         spec_json = self.hosting.find_spec(target)
         version = version or self.infer_target_version(spec_json)
-        spec_json[version] = host.binary_http_uri(target, version)
+        sha256, size = PathUtils.file_digest(archive_filepath)
+        # deltas from a version being released again don't apply anymore
+        for entry in spec_json.values():
+            if isinstance(entry, dict):
+                entry.get("deltas", {}).pop(version, None)
+
+        deltas, delta_files = {}, []
+        if delta_count and release_format == "zip":
+            with tracer.span("deltas", target=target, count=delta_count):
+                deltas, delta_files = self.make_deltas(
+                    staging_dir, host, target, version, spec_json, archive_filepath, delta_count
+                )
+
+        spec_json[version] = OrderedDict({
+            "url": host.binary_http_uri(target, version, release_format),
+            "sha256": sha256,
+            "size": size
+        })
+        if self.hosting.mirrors:
+            spec_json[version]["mirrors"] = [
+                m.binary_http_uri(target, version, release_format) for m in self.hosting.mirrors
+            ]
+        if deltas:
+            spec_json[version]["deltas"] = deltas
 
         # write spec to temp file so we can upload it
         spec_filename = TRUCK_SPEC_FILENAME.format(target=target)
         spec_filepath = os.path.join(TRUCK_TMP_DIRECTORY, spec_filename)
         PathUtils.write_json_file(spec_filepath, spec_json)
 
-        shutil.make_archive(os.path.join(staging_dir, target), 'zip', files_dir)
-        archive_filepath = os.path.join(staging_dir, target + ".zip")
-
-        print("Created {}".format(archive_filepath))
-
-        host.publish(target, version, spec_filepath, archive_filepath)
+        index_filepath = self.write_index(target, spec_json)
+        self.hosting.publish(target, version, spec_filepath, archive_filepath, delta_files, index_filepath)
 
         json_http_uri = host.spec_http_uri(target)
-        binary_http_uri = host.binary_http_uri(target, version)
+        binary_http_uri = host.binary_http_uri(target, version, release_format)
 
         print("Done! {} -> {}".format(target, version))
         print("Updated {}".format(json_http_uri))